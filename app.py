@@ -20,6 +20,7 @@ from blueprints.customer_management import bp as customer_mgmt_bp
 from datetime import datetime, date
 from config import Config
 from datetime import timedelta
+import os
 
 
 # def create_app():
@@ -27,8 +28,22 @@ app = Flask(__name__)
 
 app.config.from_object(Config)
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=1)
+# behind nginx/Apache: let the front server stream send_file() responses (X-Sendfile).
+# The dev server has no front proxy, so keep it off unless explicitly enabled.
+app.config['USE_X_SENDFILE'] = os.environ.get('SP_USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes') \
+    or bool(getattr(Config, 'USE_X_SENDFILE', False))
+# nginx: internal location aliased to static/uploads (e.g. "/protected-uploads/");
+# when set, attachment downloads are handed to nginx via X-Accel-Redirect
+app.config['ATTACHMENT_ACCEL_PREFIX'] = os.environ.get('SP_ATTACHMENT_ACCEL_PREFIX') \
+    or getattr(Config, 'ATTACHMENT_ACCEL_PREFIX', None)
 login_manager.init_app(app)
 
+@app.teardown_appcontext
+def _remove_db_session(exc=None):
+    # models.model is per-thread: hand its connection back to the pool and let
+    # the next request on this thread start with a fresh identity map
+    model.remove()
+
 from werkzeug.serving import WSGIRequestHandler
 
 # keep a reference to the original
@@ -2,6 +2,7 @@ from flask import Blueprint, render_template, redirect, url_for, flash, request,
 from flask_login import login_user, logout_user, login_required, UserMixin, current_user
 from extensions import login_manager
 from models import model, SP_Users, SP_UserBrand, SP_UserCategory, SP_UserCustomer, Brands, SP_CategoriesMappingMain, SP_Customer
+from sqlalchemy import Integer, String, cast, literal, null, select, union_all
 from werkzeug.security import check_password_hash, generate_password_hash
 from urllib.parse import quote
 from datetime import datetime, timedelta
@@ -23,6 +24,27 @@ class User(UserMixin):
         self.email = email
         self.fullname = fullname
 
+def _load_access(user_id):
+    """
+    (brand names, category IDs, customer IDs) for a user in one UNION ALL
+    round trip. Core on the session's connection, so the RBAC hook can't
+    filter the very lists it is about to be fed.
+    """
+    no_name, no_id = cast(null(), String(100)), cast(null(), Integer)
+    rows = model.connection().execute(union_all(
+        select(literal("b").label("k"), Brands.BrandName.label("name"), no_id.label("id"))
+            .join(SP_UserBrand, SP_UserBrand.BrandID == Brands.BrandID)
+            .where(SP_UserBrand.UserID == user_id),
+        select(literal("k"), no_name, SP_UserCategory.CategoryID)
+            .where(SP_UserCategory.UserID == user_id),
+        select(literal("c"), no_name, SP_UserCustomer.CustomerID)
+            .where(SP_UserCustomer.UserID == user_id),
+    )).all()
+    brands = [name for k, name, _ in rows if k == "b"]
+    cats   = [id_ for k, _, id_ in rows if k == "k"]
+    custs  = [id_ for k, _, id_ in rows if k == "c"]
+    return brands, cats, custs
+
 @login_manager.user_loader
 def load_user(user_id):
     u = model.query(SP_Users).get(user_id)
@@ -74,21 +96,10 @@ def login():
             session["user_id"]   = u.UserID
 
             # ---- ACCESS LISTS ----
-            # BRANDS -> names
-            brand_rows = (model.query(Brands.BrandName)
-                          .join(SP_UserBrand, SP_UserBrand.BrandID==Brands.BrandID)
-                          .filter(SP_UserBrand.UserID==u.UserID).all())
-            session["user_brand_access"] = [b[0] for b in brand_rows]
-
-            # CATEGORIES -> IDs from mapping table
-            cat_rows = (model.query(SP_UserCategory.CategoryID)
-                        .filter(SP_UserCategory.UserID==u.UserID).all())
-            session["user_category_access_ids"] = [cid[0] for cid in cat_rows]
-
-            # CUSTOMERS -> IDs
-            cust_rows = (model.query(SP_UserCustomer.CustomerID)
-                         .filter(SP_UserCustomer.UserID==u.UserID).all())
-            session["user_customer_access_ids"] = [cid[0] for cid in cust_rows]
+            # brands -> names; categories / customers -> IDs (one round trip)
+            (session["user_brand_access"],
+             session["user_category_access_ids"],
+             session["user_customer_access_ids"]) = _load_access(u.UserID)
 
             # Optional: send first-timers to your filter page
             return redirect(url_for("dashboard.dashboard_page"))
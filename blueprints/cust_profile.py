@@ -10,7 +10,7 @@ from flask import (
 )
 from werkzeug.utils import secure_filename
 
-from sqlalchemy import text, and_, or_, func
+from sqlalchemy import text, and_, or_, func, insert, select
 from sqlalchemy.exc import SQLAlchemyError
 
 from models import (
@@ -72,11 +72,16 @@ def _allowed_file(filename: str) -> bool:
     ext = os.path.splitext(filename)[1].lower()
     return ext in ALLOWED_EXTS
 
-def _file_hash(fpath: str) -> str:
-    h = hashlib.sha256()
-    with open(fpath, "rb") as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+def _file_hash(stream) -> str:
+    """SHA-256 of an uploaded file's stream, read in chunks; the stream is rewound."""
+    stream.seek(0)
+    if hasattr(hashlib, "file_digest"):   # 3.11+
+        h = hashlib.file_digest(stream, "sha256")
+    else:
+        h = hashlib.sha256()
+        for chunk in iter(lambda: stream.read(1024 * 1024), b""):
             h.update(chunk)
+    stream.seek(0)
     return h.hexdigest()
 
 def _load_workbook(fpath: str):
@@ -272,8 +277,10 @@ def _insert_staging(upload_id: int, customer_id: int, profile_id: Optional[int],
     start = int(mapping.get("data_start_row") or 2)
     maxr = ws.max_row or start
     fields = mapping.get("fields", {})
+    src_name = os.path.basename(fpath)
+    created_at = datetime.utcnow()
 
-    inserted = 0
+    rows: List[Dict[str, Any]] = []
     for r in range(start, maxr + 1):
         errs: List[str] = []
 
@@ -304,7 +311,7 @@ def _insert_staging(upload_id: int, customer_id: int, profile_id: Optional[int],
             "UploadID": upload_id,
             "ProfileID": profile_id,
             "CustomerID": customer_id,
-            "SourceFileName": os.path.basename(fpath),
+            "SourceFileName": src_name,
             "SourceSheet": mapping["sheet"],
             "SourceRow": r,
             "Date": dt,
@@ -318,7 +325,7 @@ def _insert_staging(upload_id: int, customer_id: int, profile_id: Optional[int],
             "Site": None,
             "ValidationErr": errs[0] if errs else None,
             "ErrorsJSON": json.dumps(errs) if errs else None,
-            "CreatedAt": datetime.utcnow(),
+            "CreatedAt": created_at,
         }
 
         # Optionals
@@ -327,12 +334,14 @@ def _insert_staging(upload_id: int, customer_id: int, profile_id: Optional[int],
                 v = cell(fields[key]["col"])
                 vals[key.capitalize() if key != "invoice" else "InvoiceNo"] = (str(v).strip() if v not in (None, "") else None)
 
-        row = SP_SellOut_Staging(**vals)
-        model.add(row)
-        inserted += 1
+        rows.append(vals)
 
+    # one executemany for the sheet (fast_executemany sends it as a parameter
+    # array) instead of a unit-of-work INSERT per staged row
+    if rows:
+        model.execute(insert(SP_SellOut_Staging.__table__), rows)
     model.commit()
-    return inserted
+    return len(rows)
 
 # ---------------------------
 # Routes
@@ -633,11 +642,23 @@ def use_profile():
 
     mapping = json.loads(det.MappingJSON)
 
+    # Hash once, before anything touches disk: a re-upload stops here instead
+    # of failing on UX_SO_Uploads_FileHash after the whole sheet is parsed.
+    # The index is global, so look past the per-user RBAC criteria (plain connection)
+    fhash = _file_hash(file.stream)
+    dup = model.connection().execute(
+        select(SP_SellOutUploads.UploadID)
+        .where(SP_SellOutUploads.SourceFileHash == fhash)
+        .limit(1)
+    ).first()
+    if dup:
+        flash(f"This exact file was already uploaded (UploadID={dup[0]}).", "warning")
+        return redirect(url_for(".use_form"))
+
     with tempfile.TemporaryDirectory() as td:
         fname = secure_filename(file.filename)
         fpath = os.path.join(td, fname)
         file.save(fpath)
-        fhash = _file_hash(fpath)
 
         # Create header row in SP_SellOutUploads (status Draft)
         hdr = SP_SellOutUploads(
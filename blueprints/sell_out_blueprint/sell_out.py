@@ -20,11 +20,14 @@ from models import (
     SP_SellOutUploads, SP_MCSI_SellOut,
     SP_SellOutUploadAudit, Brands, SP_MCSI_SellIn , SP_SOH_Detail, SP_SOH_Uploads
 )
+from utils.sellout_summary import refresh_upload_summary
+from blueprints.sell_out_blueprint.sell_out_approvals import enqueue_neg_preview
 from config import STATIC_DIR, TZ_RIYADH
 
 bp = Blueprint("sell_out", __name__, static_folder=STATIC_DIR, url_prefix="/sell-out")
 
 ALLOWED = {"xlsx","xls","csv"}
+HASH_CHUNK = 1 << 20
 
 # helper to open a transaction or savepoint safely
 def _begin_tx(session):
@@ -34,11 +37,17 @@ def _allowed(name:str)->bool:
     return "." in name and name.rsplit(".",1)[1].lower() in ALLOWED
 
 def _sha256_fs(fs)->str:
+    # hash the upload stream in chunks instead of reading it into one bytes copy
     pos = fs.stream.tell()
     fs.stream.seek(0)
-    h = hashlib.sha256(fs.stream.read()).hexdigest()
+    if hasattr(hashlib, "file_digest"):   # 3.11+
+        h = hashlib.file_digest(fs.stream, "sha256")
+    else:
+        h = hashlib.sha256()
+        for chunk in iter(lambda: fs.stream.read(HASH_CHUNK), b""):
+            h.update(chunk)
     fs.stream.seek(pos)
-    return h
+    return h.hexdigest()
 
 def _load_df(fs)->pd.DataFrame:
     ext = fs.filename.rsplit(".",1)[1].lower()
@@ -837,7 +846,8 @@ def upload():
                 CreatedBy=created_by,
                 CreatedAt=datetime.utcnow(),
                 SourceFileName=fs.filename,
-                SourceFileHash=file_hash
+                SourceFileHash=file_hash,
+                NegPreviewStatus="Pending"
             )
             model.add(header)
             model.flush()  # ensure header.UploadID available
@@ -895,7 +905,18 @@ def upload():
                 PerformedBy=created_by
             ))
 
+            # Keep list aggregates current for the new upload and the ones it deactivated
+            refresh_upload_summary(model, [header.UploadID, *hdr_ids])
+
+        # The reads above autobegin a transaction, so _begin_tx only opened a
+        # SAVEPOINT; commit the outer transaction before the teardown's remove()
+        # rolls it back, and before the background job looks for the header
+        model.commit()
+
         # ---- If we got here, everything committed atomically ----
+        # negative-stock preview is computed in the background; approvals UI polls for it
+        enqueue_neg_preview(header.UploadID)
+
         return jsonify(
             ok=True,
             upload_id=header.UploadID,
@@ -1,19 +1,31 @@
-from flask import abort, request, jsonify, flash, render_template, session
+from flask import abort, request, jsonify, flash, render_template, session, current_app, Response
 from flask import Blueprint
 from blueprints.auth import require_role
-from decimal import Decimal
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy import lambda_stmt, select, true
+from sqlalchemy.orm import raiseload, selectinload
 from contextlib import contextmanager
+from functools import lru_cache
+import threading
+import base64, hashlib, hmac, json
+from decimal import Decimal
+try:
+    import orjson
+except ImportError:  # optional: fall back to stdlib json
+    orjson = None
 from datetime import datetime, date
 import os
 from zoneinfo import ZoneInfo
 
 from models import (
-    model, distinct, or_, func,
+    model, Session, distinct, or_, and_, func, text,
     SP_SellOutUploads, SP_SellOutApproval, SP_MCSI_SellOut,
     SP_InventoryLedger, SP_Customer, SP_SellOutUploadFile, Brands,
-    SP_SOH_Uploads, SP_SOH_Detail, SP_SellOutNegPreview, joinedload
+    SP_SOH_Uploads, SP_SOH_Detail, SP_SellOutNegPreview, SP_SellOutUploadSummary, joinedload,
+    rbac_hides_rows
 )
+from utils.sellout_summary import refresh_upload_summary, scoped_detail_aggregates
+from utils import background
 
 
 from collections import defaultdict
@@ -24,6 +36,29 @@ bp = Blueprint("sell_out_approvals", __name__, static_folder=STATIC_DIR, url_pre
 class NegativeSOHError(Exception):
     pass
 
+# ---- bulk endpoint limits ----
+MAX_BULK         = 500   # ids accepted per submit/approve request
+MAX_BULK_WORKERS = 4     # bulk requests allowed to run at once (per process)
+BULK_WAIT_SECS   = 5     # how long a request may queue for a slot before 503
+_bulk_slots = threading.BoundedSemaphore(MAX_BULK_WORKERS)
+
+
+def _json_default(o):
+    if isinstance(o, Decimal):
+        return float(o)
+    if isinstance(o, (datetime, date)):
+        return o.isoformat()
+    raise TypeError(f"Type is not JSON serializable: {type(o).__name__}")
+
+def ojson(payload, status: int = 200):
+    """JSON response encoded with orjson (C) when available; skips jsonify's pure-Python path."""
+    if orjson is not None:
+        body = orjson.dumps(payload, default=_json_default,
+                            option=orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY)
+    else:
+        body = json.dumps(payload, default=_json_default)
+    return Response(body, status=status, mimetype="application/json")
+
 
 @contextmanager
 def _tx():
@@ -45,6 +80,16 @@ def approvals_ui():
 
 
 
+def _active_details(upload_id: int, db=model) -> list[SP_MCSI_SellOut]:
+    """Active detail rows of an upload ordered (SKU, date, row); lambda_stmt keeps the compiled SQL cached."""
+    stmt = lambda_stmt(lambda: select(SP_MCSI_SellOut)
+                       .where(SP_MCSI_SellOut.UploadID == upload_id,
+                              SP_MCSI_SellOut.IsActive == true())
+                       .order_by(SP_MCSI_SellOut.SKU_ID.asc(),
+                                 SP_MCSI_SellOut.DocumentDate.asc(),
+                                 SP_MCSI_SellOut.RowNumber.asc()))
+    return db.execute(stmt).scalars().all()
+
 def _post_sellout_running(upload: SP_SellOutUploads, actor: str, comment: str | None):
     """
     Approve & post a sell-out upload:
@@ -57,13 +102,7 @@ def _post_sellout_running(upload: SP_SellOutUploads, actor: str, comment: str |
         raise ValueError(f"Upload {upload.UploadID} already posted")
 
     # 1) pull active detail rows for this upload
-    details = (model.query(SP_MCSI_SellOut)
-               .filter(SP_MCSI_SellOut.UploadID == upload.UploadID,
-                       SP_MCSI_SellOut.IsActive == True)
-               .order_by(SP_MCSI_SellOut.SKU_ID.asc(),
-                         SP_MCSI_SellOut.DocumentDate.asc(),
-                         SP_MCSI_SellOut.RowNumber.asc())
-               .all())
+    details = _active_details(upload.UploadID)
     if not details:
         raise ValueError("No active detail rows to post")
 
@@ -94,68 +133,110 @@ def _post_sellout_running(upload: SP_SellOutUploads, actor: str, comment: str |
         Actor=actor or "approver",
         Comment=comment
     ))
+    refresh_upload_summary(model, [upload.UploadID])
 
-def _latest_active_snapshot(customer_id: int, brand: str | None, sku_id: int, as_of: date):
+def _latest_active_snapshot(customer_id: int, brand: str | None, sku_id: int, as_of: date, db=model):
     """
     Return (snap_date, snap_qty) from the latest ACTIVE snapshot for (customer, brand?, sku)
     with SOHDate <= as_of. None if no snapshot.
     """
-    q = (model.query(SP_SOH_Detail.SOHDate, SP_SOH_Detail.SOHQty)
-         .join(SP_SOH_Uploads, SP_SOH_Uploads.SOHUploadID == SP_SOH_Detail.SOHUploadID)
-         .filter(SP_SOH_Uploads.CustomerID == customer_id,
-                 SP_SOH_Detail.SKU_ID == sku_id,
-                 SP_SOH_Detail.IsActive == True,
-                 SP_SOH_Detail.SOHDate <= as_of))
+    stmt = lambda_stmt(lambda: select(SP_SOH_Detail.SOHDate, SP_SOH_Detail.SOHQty)
+                       .join(SP_SOH_Uploads, SP_SOH_Uploads.SOHUploadID == SP_SOH_Detail.SOHUploadID)
+                       .where(SP_SOH_Uploads.CustomerID == customer_id,
+                              SP_SOH_Detail.SKU_ID == sku_id,
+                              SP_SOH_Detail.IsActive == True,
+                              SP_SOH_Detail.SOHDate <= as_of))
     if brand:
-        q = q.filter(SP_SOH_Uploads.Brand == brand)
-    q = q.order_by(SP_SOH_Detail.SOHDate.desc(), SP_SOH_Uploads.SOHUploadID.desc())
-    row = q.first()
+        stmt += lambda s: s.where(SP_SOH_Uploads.Brand == brand)
+    stmt += lambda s: s.order_by(SP_SOH_Detail.SOHDate.desc(), SP_SOH_Uploads.SOHUploadID.desc()).limit(1)
+    row = db.execute(stmt).first()
     return (row[0], float(row[1])) if row else (None, 0.0)
 
-def _sum_ledger_between(customer_id: int, sku_id: int, since_excl: date | None, until_incl: date):
+def _sum_ledger_between(customer_id: int, sku_id: int, since_excl: date | None, until_incl: date, db=model):
     """
     Sum signed ledger Qty for (customer, sku) in (since_excl, until_incl].
     If since_excl is None, sum from 'beginning' up to until_incl.
     """
-    q = (model.query(func.coalesce(func.sum(SP_InventoryLedger.Qty), 0.0))
-         .filter(SP_InventoryLedger.CustomerID == customer_id,
-                 SP_InventoryLedger.SKU_ID == sku_id,
-                 SP_InventoryLedger.DocDate <= until_incl))
+    stmt = lambda_stmt(lambda: select(func.coalesce(func.sum(SP_InventoryLedger.Qty), 0.0))
+                       .where(SP_InventoryLedger.CustomerID == customer_id,
+                              SP_InventoryLedger.SKU_ID == sku_id,
+                              SP_InventoryLedger.DocDate <= until_incl))
     if since_excl:
-        q = q.filter(SP_InventoryLedger.DocDate > since_excl)
-    return float(q.scalar() or 0.0)
+        stmt += lambda s: s.where(SP_InventoryLedger.DocDate > since_excl)
+    return float(db.execute(stmt).scalar() or 0.0)
 
-def _balance_as_of(customer_id: int, brand: str | None, sku_id: int, as_of: date) -> float:
+def _balance_as_of(customer_id: int, brand: str | None, sku_id: int, as_of: date, db=model) -> float:
     """
     Compute stock as of 'as_of' date:
       latest_active_snapshot_qty + sum(ledger movements after snapshot_date .. as_of)
     """
-    snap_date, snap_qty = _latest_active_snapshot(customer_id, brand, sku_id, as_of)
-    delta = _sum_ledger_between(customer_id, sku_id, snap_date, as_of)
+    snap_date, snap_qty = _latest_active_snapshot(customer_id, brand, sku_id, as_of, db=db)
+    delta = _sum_ledger_between(customer_id, sku_id, snap_date, as_of, db=db)
     return float(snap_qty) + float(delta)
 
+@contextmanager
+def _bulk_slot():
+    """Bounded admission for bulk endpoints; yields False if no slot freed up in time."""
+    acquired = _bulk_slots.acquire(timeout=BULK_WAIT_SECS)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            _bulk_slots.release()
+
+def _try_lock_upload(upload_id: int) -> bool:
+    """
+    Single-flight guard: take a transaction-scoped app lock on the upload
+    (sp_getapplock, released on commit/rollback). Returns False if another
+    request already holds it. No-op on non-SQL Server backends (sqlite dev).
+    """
+    if model.get_bind().dialect.name != "mssql":
+        return True
+    res = model.execute(text("""
+        SET NOCOUNT ON;
+        DECLARE @r INT;
+        EXEC @r = sp_getapplock @Resource = :res, @LockMode = 'Exclusive',
+                                @LockOwner = 'Transaction', @LockTimeout = 0;
+        SELECT @r;
+    """), {"res": f"sellout_upload_{int(upload_id)}"}).scalar()
+    return res is not None and int(res) >= 0
+
+def _parse_ids(ids) -> list[int]:
+    if isinstance(ids, str):
+        return [int(x) for x in ids.split(",") if x.strip().isdigit()]
+    return [int(x) for x in ids]
+
+def _preload_uploads(ids: list[int]) -> list[SP_SellOutUploads]:
+    """
+    One IN (...) query that puts the uploads into the identity map, so the
+    per-id model.get() calls in the bulk loops don't go back to the DB.
+    Keep the returned list alive for the loop (the identity map is weak-referencing).
+    """
+    if not ids:
+        return []
+    return (model.query(SP_SellOutUploads)
+            .filter(SP_SellOutUploads.UploadID.in_(ids))
+            .all())
+
 def _get_upload_or_404(upload_id:int):
-    obj = model.query(SP_SellOutUploads).get(upload_id)
+    obj = model.get(SP_SellOutUploads, upload_id)
     if not obj:
         abort(404, description="Upload not found")
     return obj
 
-def _preview_negatives(upload: SP_SellOutUploads):
+def _preview_negatives(upload: SP_SellOutUploads, for_persist: bool = False, db=model):
     """
     Returns (has_negatives, per_line_info)
     per_line_info is a list of dicts keyed by RowNumber with:
       SKU_ID, DocumentDate, SellOutQty, AvailableBefore, CumulativeFromUpload, ResultingBalance, IsNegative
     Per-line cumulative: if the same SKU appears multiple times on the same day,
     we compute using a single 'available before' for that day and add each line’s quantity sequentially.
+    With for_persist=True the lines are SP_SellOutNegPreview mappings (UploadID added,
+    DocumentDate kept as a date, numbers left as driver-native floats) so they can go
+    straight into bulk_insert_mappings without a float -> str -> Decimal round trip.
     """
     brand = upload.Brand
-    details = (model.query(SP_MCSI_SellOut)
-               .filter(SP_MCSI_SellOut.UploadID == upload.UploadID,
-                       SP_MCSI_SellOut.IsActive == True)
-               .order_by(SP_MCSI_SellOut.SKU_ID.asc(),
-                         SP_MCSI_SellOut.DocumentDate.asc(),
-                         SP_MCSI_SellOut.RowNumber.asc())
-               .all())
+    details = _active_details(upload.UploadID, db=db)
     if not details:
         return False, []
 
@@ -177,7 +258,7 @@ def _preview_negatives(upload: SP_SellOutUploads):
         for d in rows:
             if d.DocumentDate != last_date:
                 # Recompute availability once at the switch to a new date
-                available_for_date = _balance_as_of(upload.CustomerID, brand, sku_id, d.DocumentDate)
+                available_for_date = _balance_as_of(upload.CustomerID, brand, sku_id, d.DocumentDate, db=db)
                 last_date = d.DocumentDate
 
             qty = float(d.SellOutQty or 0.0)
@@ -186,26 +267,49 @@ def _preview_negatives(upload: SP_SellOutUploads):
             is_neg = (resulting < -1e-9)
             has_neg = has_neg or is_neg
 
-            per_line.append({
+            line = {
                 "RowNumber": d.RowNumber,
                 "SKU_ID": d.SKU_ID,
-                "DocumentDate": str(d.DocumentDate),
+                "DocumentDate": d.DocumentDate if for_persist else str(d.DocumentDate),
                 "SellOutQty": qty,
                 "AvailableBefore": float(available_for_date),
                 "CumulativeFromUpload": float(cum_total),
                 "ResultingBalance": float(resulting),
                 "IsNegative": bool(is_neg),
-            })
+            }
+            if for_persist:
+                line["UploadID"] = upload.UploadID
+            per_line.append(line)
 
     return has_neg, per_line
 
+def _preview_for_json(lines: list[dict]) -> list[dict]:
+    """Turn persist-shaped preview lines back into the JSON shape used by the UI."""
+    return [{
+        "RowNumber": r["RowNumber"],
+        "SKU_ID": r["SKU_ID"],
+        "DocumentDate": str(r["DocumentDate"]),
+        "SellOutQty": r["SellOutQty"],
+        "AvailableBefore": r["AvailableBefore"],
+        "CumulativeFromUpload": r["CumulativeFromUpload"],
+        "ResultingBalance": r["ResultingBalance"],
+        "IsNegative": r["IsNegative"],
+    } for r in lines]
+
 def _load_persisted_preview(upload_id: int):
-    rows = (model.query(SP_SellOutNegPreview)
-            .filter(SP_SellOutNegPreview.UploadID == upload_id)
-            .order_by(SP_SellOutNegPreview.RowNumber.asc())
-            .all())
-    if not rows:
-        return None
+    """
+    Persisted preview lines for an upload as (has_neg, per_line); an upload with
+    no active lines has none, which is a valid (empty) answer. Reads through
+    model.connection() so the per-user RBAC criteria don't drop lines the
+    header flags were computed from.
+    """
+    P = SP_SellOutNegPreview.__table__.c
+    rows = model.connection().execute(
+        select(P.RowNumber, P.SKU_ID, P.DocumentDate, P.SellOutQty, P.AvailableBefore,
+               P.CumulativeFromUpload, P.ResultingBalance, P.IsNegative)
+        .where(P.UploadID == upload_id)
+        .order_by(P.RowNumber.asc())
+    ).all()
     per_line = [{
         "RowNumber": r.RowNumber,
         "SKU_ID": r.SKU_ID,
@@ -219,67 +323,122 @@ def _load_persisted_preview(upload_id: int):
     has_neg = any(x["IsNegative"] for x in per_line)
     return has_neg, per_line
 
-def _compute_and_persist_preview(upload: SP_SellOutUploads):
-    has_neg, per_line = _preview_negatives(upload)
+def _compute_and_persist_preview(upload: SP_SellOutUploads, started: datetime, db=model) -> bool:
+    """
+    Recompute the negative-stock preview, replace the persisted rows and
+    refresh the header flags. `started` is the NegPreviewComputedAt stamp the
+    caller committed before any ledger/SOH read; the header only turns Ready
+    if it is still there. Returns False (nothing marked fresh) when a trigger
+    cleared it meanwhile, i.e. the data moved under the computation.
+    """
+    has_neg, per_line = _preview_negatives(upload, for_persist=True, db=db)
 
     # 1) Clear old rows for this upload (ORM delete)
-    model.query(SP_SellOutNegPreview)\
+    db.query(SP_SellOutNegPreview)\
          .filter(SP_SellOutNegPreview.UploadID == upload.UploadID)\
          .delete(synchronize_session=False)
 
-    # 2) Insert new rows (ORM bulk)
-    objs = []
-    for r in per_line:
-        # Normalize types
-        doc_date = r["DocumentDate"]
-        if isinstance(doc_date, str):
-            # 'YYYY-MM-DD' from your JSON; convert to date
-            doc_date = date.fromisoformat(doc_date)
-
-        def dec_or_none(x):
-            if x is None:
-                return None
-            # Accept float/str -> Decimal
-            return Decimal(str(x))
-
-        objs.append(SP_SellOutNegPreview(
-            UploadID             = upload.UploadID,
-            RowNumber            = int(r["RowNumber"]),
-            SKU_ID               = int(r["SKU_ID"]),
-            DocumentDate         = doc_date,
-            SellOutQty           = dec_or_none(r.get("SellOutQty", 0)),
-            AvailableBefore      = dec_or_none(r.get("AvailableBefore")),
-            CumulativeFromUpload = dec_or_none(r.get("CumulativeFromUpload")),
-            ResultingBalance     = dec_or_none(r.get("ResultingBalance")),
-            IsNegative           = bool(r.get("IsNegative", False)),
-        ))
-
-    if objs:
-        # Use bulk_save_objects for speed; add_all is fine too.
-        model.bulk_save_objects(objs)
-
-    # 3) Update header flags
-    upload.HasPotentialNegatives = bool(has_neg)
-    upload.NegPreviewComputedAt  = datetime.utcnow()
-
-    model.flush()
+    # 2) Insert new rows straight from the mappings (Numeric binds accept floats)
+    if per_line:
+        db.bulk_insert_mappings(SP_SellOutNegPreview, per_line)
+
+    # 3) Update header flags, only if no trigger has cleared our stamp
+    updated = db.query(SP_SellOutUploads)\
+                .filter(SP_SellOutUploads.UploadID == upload.UploadID,
+                        SP_SellOutUploads.NegPreviewComputedAt == started)\
+                .update({SP_SellOutUploads.HasPotentialNegatives: bool(has_neg),
+                         SP_SellOutUploads.NegPreviewStatus: "Ready"},
+                        synchronize_session=False)
+    return bool(updated)
+
+def _run_neg_preview(upload_id: int):
+    """Background job: compute + persist the preview on its own session (no request context here)."""
+    db = Session()
+    try:
+        # Stamp the start before reading anything (whole seconds compare exactly
+        # across DATETIME/DATETIME2). The stale-preview triggers NULL it if
+        # ledger/SOH data changes from here on, so a stale result can't go Ready.
+        started = datetime.utcnow().replace(microsecond=0)
+        claimed = db.query(SP_SellOutUploads)\
+                    .filter(SP_SellOutUploads.UploadID == upload_id)\
+                    .update({SP_SellOutUploads.NegPreviewComputedAt: started},
+                            synchronize_session=False)
+        db.commit()
+        if not claimed:
+            return
+        u = db.get(SP_SellOutUploads, upload_id)
+        try:
+            if _compute_and_persist_preview(u, started, db=db):
+                db.commit()
+            else:
+                # left Pending with a NULL stamp: the next details GET re-queues
+                db.rollback()
+        except Exception:
+            db.rollback()
+            # Failed is a settled answer the details view serves as-is until
+            # ?recompute=1 or a trigger clears the stamp
+            db.query(SP_SellOutUploads)\
+              .filter(SP_SellOutUploads.UploadID == upload_id,
+                      SP_SellOutUploads.NegPreviewComputedAt == started)\
+              .update({SP_SellOutUploads.NegPreviewStatus: "Failed"}, synchronize_session=False)
+            db.commit()
+            raise
+    finally:
+        db.close()
+
+def enqueue_neg_preview(upload_id: int) -> bool:
+    """
+    Queue the negative-stock preview for an upload. Callers mark the header
+    NegPreviewStatus='Pending' in their own transaction. Returns False if a
+    job for this upload is already queued/running in this process.
+    """
+    return background.submit(_run_neg_preview, int(upload_id), key=("neg_preview", int(upload_id)))
 
 def _write_approval(upload_id:int, action:str, actor:str, comment:str|None):
     model.add(SP_SellOutApproval(
         UploadID=upload_id, Action=action, Actor=actor or "system", Comment=comment
     ))
 
+_UTC = ZoneInfo("UTC")
+
+# many rows on a page share CreatedAt/UploadedAt/ActedAt values; datetimes are hashable
+@lru_cache(maxsize=4096)
 def _fmt_dt_local(dt):
     if not dt: return None
-    try: return dt.replace(tzinfo=ZoneInfo("UTC")).astimezone(TZ_RIYADH).strftime("%Y-%m-%d %H:%M")
+    try: return dt.replace(tzinfo=_UTC).astimezone(TZ_RIYADH).strftime("%Y-%m-%d %H:%M")
     except Exception: return dt.isoformat()
 
 
+def _cursor_mac(payload: bytes) -> str:
+    # bind the token to the signed-in user so it can't be replayed across accounts
+    key = current_app.secret_key or ""
+    if isinstance(key, str):
+        key = key.encode()
+    msg = payload + b"|" + str(session.get("user_id") or "").encode()
+    return hmac.new(key, msg, hashlib.sha256).hexdigest()[:32]
+
+def _encode_cursor(created_at: datetime, upload_id: int) -> str:
+    payload = base64.urlsafe_b64encode(json.dumps([created_at.isoformat(), int(upload_id)]).encode())
+    return payload.decode() + "." + _cursor_mac(payload)
+
+def _decode_cursor(token: str):
+    """Returns (created_at, upload_id) or None if the token is malformed or not ours."""
+    try:
+        payload, mac = token.rsplit(".", 1)
+        if not hmac.compare_digest(mac, _cursor_mac(payload.encode())):
+            return None
+        ts, uid = json.loads(base64.urlsafe_b64decode(payload.encode()))
+        return datetime.fromisoformat(ts), int(uid)
+    except Exception:
+        return None
+
+
 # ---- list pending ----
 @bp.route("/approvals/pending", methods=["GET"])
 @require_role("brand_manager","finance_manager","admin","developer")
 def list_pending():
     q = model.query(SP_SellOutUploads)\
+             .options(raiseload("*"))\
              .filter(SP_SellOutUploads.Status=="Draft")\
              .order_by(SP_SellOutUploads.CreatedAt.desc())
     # optional filters
@@ -307,7 +466,7 @@ def approval_details(upload_id:int):
     u = _get_upload_or_404(upload_id)
 
     det = (model.query(SP_MCSI_SellOut)
-           .options(joinedload(SP_MCSI_SellOut.SKU))  # eager-load SP_SKU
+           .options(joinedload(SP_MCSI_SellOut.SKU), raiseload("*"))  # eager-load SP_SKU, nothing else
            .filter(SP_MCSI_SellOut.UploadID == upload_id)
            .order_by(SP_MCSI_SellOut.SKU_ID.asc(),
                      SP_MCSI_SellOut.DocumentDate.asc(),
@@ -327,29 +486,37 @@ def approval_details(upload_id:int):
 
     force = (request.args.get("recompute") or "").lower() in ("1","true","yes")
 
-    cached = None if force else _load_persisted_preview(u.UploadID)
-    if cached:
-        has_neg, per_line_preview = cached
+    # The preview is computed off the request path; the header says whether it
+    # is settled. NegPreviewComputedAt is cleared by DB triggers when ledger/SOH
+    # data under this upload changes, so a NULL means the last answer is stale.
+    # Failed is settled too: it is shown, and only retried on ?recompute=1.
+    settled = (u.NegPreviewStatus in ("Ready", "Failed")
+               and u.NegPreviewComputedAt is not None)
+    if settled and not force:
+        preview_status = u.NegPreviewStatus
+        if preview_status == "Ready":
+            has_neg, per_line_preview = _load_persisted_preview(u.UploadID)
+        else:
+            has_neg, per_line_preview = bool(u.HasPotentialNegatives), []
     else:
-        has_neg, per_line_preview = _preview_negatives(u)
-        # ⬇️ make the persisted preview durable
-        try:
+        has_neg, per_line_preview = bool(u.HasPotentialNegatives), []
+        if force or u.NegPreviewStatus != "Pending" or not background.is_inflight(("neg_preview", u.UploadID)):
             with _tx():
-                _compute_and_persist_preview(u)
-        except Exception:
-            pass
-
-    return jsonify(ok=True, 
-                   header={
-                       "UploadID": u.UploadID, "Status": u.Status, "Brand": u.Brand,
-                       "CustomerID": u.CustomerID,
-                       "Period":[str(u.PeriodStart), str(u.PeriodEnd)],
-                       "CreatedBy": u.CreatedBy, "CreatedAt": u.CreatedAt.isoformat(),
-                       "HasPotentialNegatives": bool(has_neg if (force or not cached) 
-                                                     else getattr(u, "HasPotentialNegatives", False))
-                   },
-                   details=details,
-                   warnings=per_line_preview)
+                u.NegPreviewStatus = "Pending"
+            enqueue_neg_preview(u.UploadID)
+        preview_status = "Pending"
+
+    return ojson({"ok": True,
+                  "header": {
+                      "UploadID": u.UploadID, "Status": u.Status, "Brand": u.Brand,
+                      "CustomerID": u.CustomerID,
+                      "Period":[str(u.PeriodStart), str(u.PeriodEnd)],
+                      "CreatedBy": u.CreatedBy, "CreatedAt": u.CreatedAt.isoformat(),
+                      "HasPotentialNegatives": bool(has_neg),
+                      "NegPreviewStatus": preview_status,
+                  },
+                  "details": details,
+                  "warnings": per_line_preview})
 
 # ---- submit (move Draft/Rejected -> Draft) ----
 @bp.route("/approvals/submit-bulk", methods=["POST"])
@@ -362,28 +529,39 @@ def submit_bulk():
 
     if not ids:
         return jsonify(ok=False, error="ids required"), 400
-    if isinstance(ids, str):
-        ids = [int(x) for x in ids.split(",") if x.strip().isdigit()]
-    else:
-        ids = [int(x) for x in ids]
+    ids = _parse_ids(ids)
+    if len(ids) > MAX_BULK:
+        return jsonify(ok=False, error=f"Too many ids (max {MAX_BULK} per request)"), 413
 
     submitted, skipped, failed = [], [], []
-    for upload_id in ids:
-        try:
-            u = model.query(SP_SellOutUploads).get(upload_id)
-            if not u:
-                failed.append({"UploadID": upload_id, "error": "not found"}); continue
-            if u.Status not in ("Draft", "Rejected"):
-                skipped.append({"UploadID": upload_id, "Status": u.Status}); continue
-            u.Status = "Draft"
-            model.add(SP_SellOutApproval(
-                UploadID=upload_id, Action="SUBMIT", Actor=actor, Comment=comment
-            ))
-            model.commit()
-            submitted.append(upload_id)
-        except Exception as e:
-            model.rollback()
-            failed.append({"UploadID": upload_id, "error": str(e)})
+    with _bulk_slot() as acquired:
+        if not acquired:
+            return jsonify(ok=False, error="Server busy, retry shortly"), 503, {"Retry-After": str(BULK_WAIT_SECS)}
+        _preloaded = _preload_uploads(ids)
+        for upload_id in ids:
+            try:
+                # early exits end the (empty) transaction with commit, not rollback:
+                # rollback would expire the preloaded uploads and force a reload each
+                if not _try_lock_upload(upload_id):
+                    model.commit()
+                    skipped.append({"UploadID": upload_id, "reason": "in-progress"}); continue
+                u = model.get(SP_SellOutUploads, upload_id)
+                if not u:
+                    model.commit()
+                    failed.append({"UploadID": upload_id, "error": "not found"}); continue
+                if u.Status not in ("Draft", "Rejected"):
+                    model.commit()
+                    skipped.append({"UploadID": upload_id, "Status": u.Status}); continue
+                u.Status = "Draft"
+                model.add(SP_SellOutApproval(
+                    UploadID=upload_id, Action="SUBMIT", Actor=actor, Comment=comment
+                ))
+                refresh_upload_summary(model, [upload_id])
+                model.commit()
+                submitted.append(upload_id)
+            except Exception as e:
+                model.rollback()
+                failed.append({"UploadID": upload_id, "error": str(e)})
 
     return jsonify(ok=True, submitted=submitted, skipped=skipped, failed=failed)
 
@@ -398,36 +576,42 @@ def approve_uploads():
 
     if not ids:
         return jsonify(ok=False, error="ids required"), 400
-    if isinstance(ids, str):
-        ids = [int(x) for x in ids.split(",") if x.strip().isdigit()]
-    else:
-        ids = [int(x) for x in ids]
+    ids = _parse_ids(ids)
+    if len(ids) > MAX_BULK:
+        return jsonify(ok=False, error=f"Too many ids (max {MAX_BULK} per request)"), 413
 
     posted, skipped, failed = [], [], []
-    for upload_id in ids:
-        try:
-            with _tx():
-                u = _get_upload_or_404(upload_id)
-
-                # Claim atomically: Draft -> Posting (NOT Posted yet)
-                affected = (model.query(SP_SellOutUploads)
-                            .filter(SP_SellOutUploads.UploadID == u.UploadID,
-                                    SP_SellOutUploads.Status == "Draft")
-                            .update({SP_SellOutUploads.Status: "Posting"}, synchronize_session=False))
-                model.flush()
-                if affected != 1:
-                    skipped.append({"UploadID": upload_id, "Status": u.Status})
-                    continue
-
-                # Now do the heavy work; will set Status="Posted" on success
-                _post_sellout_running(u, actor, comment)
-                posted.append(upload_id)
-        except NegativeSOHError as e:
-            try: flash(str(e), "danger")
-            except Exception: pass
-            failed.append({"UploadID": upload_id, "error": str(e)})
-        except Exception as e:
-            failed.append({"UploadID": upload_id, "error": str(e)})
+    with _bulk_slot() as acquired:
+        if not acquired:
+            return jsonify(ok=False, error="Server busy, retry shortly"), 503, {"Retry-After": str(BULK_WAIT_SECS)}
+        _preloaded = _preload_uploads(ids)
+        for upload_id in ids:
+            try:
+                with _tx():
+                    if not _try_lock_upload(upload_id):
+                        skipped.append({"UploadID": upload_id, "reason": "in-progress"})
+                        continue
+                    u = _get_upload_or_404(upload_id)
+
+                    # Claim atomically: Draft -> Posting (NOT Posted yet)
+                    affected = (model.query(SP_SellOutUploads)
+                                .filter(SP_SellOutUploads.UploadID == u.UploadID,
+                                        SP_SellOutUploads.Status == "Draft")
+                                .update({SP_SellOutUploads.Status: "Posting"}, synchronize_session=False))
+                    model.flush()
+                    if affected != 1:
+                        skipped.append({"UploadID": upload_id, "Status": u.Status})
+                        continue
+
+                    # Now do the heavy work; will set Status="Posted" on success
+                    _post_sellout_running(u, actor, comment)
+                    posted.append(upload_id)
+            except NegativeSOHError as e:
+                try: flash(str(e), "danger")
+                except Exception: pass
+                failed.append({"UploadID": upload_id, "error": str(e)})
+            except Exception as e:
+                failed.append({"UploadID": upload_id, "error": str(e)})
 
     return jsonify(ok=True, posted=posted, skipped=skipped, failed=failed)
 
@@ -455,6 +639,7 @@ def reject_uploads():
             u.ApprovedBy = None
             u.ApprovedAt = None
             _write_approval(upload_id, "REJECT", actor, comment)
+        refresh_upload_summary(model, ids)
 
     return jsonify(ok=True, rejected=ids)
 
@@ -465,6 +650,9 @@ def list_uploads():
     Returns paginated sell-out uploads with summary + attachments for line-item UI.
     Query params (optional):
       - page, page_size
+      - cursor  (keyset paging on CreatedAt, UploadID; pass the previous response's
+                 next_cursor, or an empty value for the first page. No COUNT(*) is
+                 run in this mode unless include_total=1)
       - status: Draft|Rejected|Posted
       - brand
       - customer_id
@@ -479,9 +667,19 @@ def list_uploads():
     date_from = request.args.get("date_from")  # ISO date
     date_to   = request.args.get("date_to")
     q         = (request.args.get("q") or "").strip() or None
+    use_cursor = "cursor" in request.args
+    cursor_tok = (request.args.get("cursor") or "").strip()
+    include_total = (request.args.get("include_total") or "").lower() in ("1","true","yes")
+
+    after = None
+    if use_cursor and cursor_tok:
+        after = _decode_cursor(cursor_tok)
+        if after is None:
+            return jsonify(ok=False, error="Invalid cursor"), 400
 
     base = model.query(SP_SellOutUploads, SP_Customer.CustName, SP_Customer.CustCode)\
-        .join(SP_Customer, SP_Customer.CustomerID == SP_SellOutUploads.CustomerID)
+        .join(SP_Customer, SP_Customer.CustomerID == SP_SellOutUploads.CustomerID)\
+        .options(selectinload(SP_SellOutUploads.Approver), raiseload("*"))
 
     if status:  base = base.filter(SP_SellOutUploads.Status == status)
     if brand:   base = base.filter(SP_SellOutUploads.Brand == brand)
@@ -493,51 +691,42 @@ def list_uploads():
         base = base.filter(
             (SP_SellOutUploads.CreatedBy.ilike(like)) |
             (SP_SellOutUploads.SourceFileName.ilike(like))
-            .options(joinedload(SP_SellOutUploads.Approver))
         )
 
-    # aggregates over detail (active rows only)
-    agg = model.query(
-        SP_MCSI_SellOut.UploadID.label("UploadID"),
-        func.count().label("RowCount"),
-        func.count(distinct(SP_MCSI_SellOut.SKU_ID)).label("DistinctSKU"),
-        func.coalesce(func.sum(SP_MCSI_SellOut.SellOutQty), 0.0).label("TotalSellOutQty"),
-    )\
-     .group_by(SP_MCSI_SellOut.UploadID)\
-     .subquery()
-
-    # attachment counts (optional list comes next)
-    att_agg = model.query(
-        SP_SellOutUploadFile.UploadID.label("UploadID"),
-        func.count().label("AttachmentCount")
-    ).group_by(SP_SellOutUploadFile.UploadID).subquery()
-
-    # most recent approval action (for quick display)
-    last_appr = model.query(
-        SP_SellOutApproval.UploadID.label("UploadID"),
-        func.max(SP_SellOutApproval.ActedAt).label("LastActedAt")
-    ).group_by(SP_SellOutApproval.UploadID).subquery()
-
     # apply pagination
-    total = base.count()
-    # JOIN + SELECT the subquery columns explicitly
-    rows = (
+    total = base.count() if (not use_cursor or include_total) else None
+    # aggregates come precomputed from SP_SellOutUploadSummary (refreshed on write)
+    paged = (
         base
-        .outerjoin(agg,     agg.c.UploadID     == SP_SellOutUploads.UploadID)
-        .outerjoin(att_agg, att_agg.c.UploadID == SP_SellOutUploads.UploadID)
-        .outerjoin(last_appr, last_appr.c.UploadID == SP_SellOutUploads.UploadID)
-        .add_columns(
-            func.coalesce(agg.c.RowCount, 0).label("RowCount"),
-            func.coalesce(agg.c.DistinctSKU, 0).label("DistinctSKU"),
-            func.coalesce(agg.c.TotalSellOutQty, 0.0).label("TotalSellOutQty"),
-            func.coalesce(att_agg.c.AttachmentCount, 0).label("AttachmentCount"),
-            last_appr.c.LastActedAt.label("LastActedAt"),
-        )
-        .order_by(SP_SellOutUploads.CreatedAt.desc())
-        .offset((page - 1) * page_size)
-        .limit(page_size)
-        .all()
+        .outerjoin(SP_SellOutUploadSummary, SP_SellOutUploadSummary.UploadID == SP_SellOutUploads.UploadID)
+        .add_entity(SP_SellOutUploadSummary)
+        .order_by(SP_SellOutUploads.CreatedAt.desc(), SP_SellOutUploads.UploadID.desc())
     )
+    if use_cursor:
+        if after:
+            ts, uid = after
+            paged = paged.filter(or_(SP_SellOutUploads.CreatedAt < ts,
+                                     and_(SP_SellOutUploads.CreatedAt == ts,
+                                          SP_SellOutUploads.UploadID < uid)))
+        rows = paged.limit(page_size + 1).all()
+    else:
+        rows = paged.offset((page - 1) * page_size).limit(page_size + 1).all()
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    last_u = rows[-1][0] if rows else None
+    next_cursor = (_encode_cursor(last_u.CreatedAt, last_u.UploadID)
+                   if has_more and last_u is not None and last_u.CreatedAt else None)
+
+    # uploads written before the summary table existed: backfill just this page
+    missing = [u.UploadID for (u, *_rest, summ) in rows if summ is None]
+    computed = {}
+    if missing:
+        try:
+            with _tx():
+                computed = refresh_upload_summary(model, missing)
+        except Exception:
+            current_app.logger.exception("Failed to backfill sell-out upload summaries")
 
     # collect upload ids to fetch attachments (for preview links)
     upload_ids = [u.UploadID for (u, *_rest) in rows]
@@ -556,8 +745,23 @@ def list_uploads():
                 "Url": f"/sell_out_uploads/upload-attachment/load/{a.ServerID}"  # FilePond load endpoint
             })
 
+    # the shared summary counts every line; category/SKU-scoped users get their
+    # line aggregates through the RBAC-filtered query instead
+    scoped = (scoped_detail_aggregates(model, upload_ids)
+              if upload_ids and rbac_hides_rows(SP_MCSI_SellOut) else None)
+
     items = []
-    for (u, cust_name, cust_code, rowcount, distinct_sku, total_qty, att_count, last_acted) in rows:
+    for (u, cust_name, cust_code, summ) in rows:
+        if summ is not None:
+            rowcount, distinct_sku, total_qty = summ.RowCount, summ.DistinctSKU, summ.TotalSellOutQty
+            att_count, last_acted = summ.AttachmentCount, summ.LastActedAt
+        else:
+            fresh = computed.get(u.UploadID, {})
+            rowcount, distinct_sku, total_qty = fresh.get("RowCount"), fresh.get("DistinctSKU"), fresh.get("TotalSellOutQty")
+            att_count, last_acted = fresh.get("AttachmentCount"), fresh.get("LastActedAt")
+        if scoped is not None:
+            mine = scoped[u.UploadID]
+            rowcount, distinct_sku, total_qty = mine["RowCount"], mine["DistinctSKU"], mine["TotalSellOutQty"]
         items.append({
             "UploadID": u.UploadID,
             "Status": u.Status,
@@ -586,25 +790,27 @@ def list_uploads():
             "LastApprovalActionAt": _fmt_dt_local(last_acted) if last_acted else None,
             "Notes": u.Notes,
             "HasPotentialNegatives": bool(getattr(u, "HasPotentialNegatives", False)),
+            "NegPreviewStale": u.NegPreviewComputedAt is None,
             "SupersededByUploadID": u.SupersededByUploadID,
         })
     
     # has_neg = False
     # try:
     #     # Only compute for visible rows (cheap). Uses your existing preview logic.
-    #     u_for_flag = model.query(SP_SellOutUploads).get(u.UploadID)
+    #     u_for_flag = model.get(SP_SellOutUploads, u.UploadID)
     #     has_neg, _ = _preview_negatives(u_for_flag)
     # except Exception:
     #     has_neg = False
     
     # items[-1]["HasPotentialNegatives"] = bool(has_neg)
 
-    return jsonify(ok=True, page=page, page_size=page_size, total=total, items=items)
+    return ojson({"ok": True, "page": None if use_cursor else page, "page_size": page_size,
+                  "total": total, "next_cursor": next_cursor, "has_more": has_more, "items": items})
 
 # ---- detail for a single upload (for line-item UI) ----
 @bp.route("/uploads/<int:upload_id>", methods=["GET"])
 def upload_detail(upload_id: int):
-    u = model.query(SP_SellOutUploads).get(upload_id)
+    u = model.get(SP_SellOutUploads, upload_id)
     if not u:
         return jsonify(ok=False, error="Not found"), 404
 
@@ -617,7 +823,7 @@ def upload_detail(upload_id: int):
         func.count(distinct(SP_MCSI_SellOut.SKU_ID)).label("DistinctSKU"),
         func.coalesce(func.sum(SP_MCSI_SellOut.SellOutQty), 0.0).label("TotalSellOutQty"),
     ).filter(SP_MCSI_SellOut.UploadID == upload_id,
-             SP_MCSI_SellOut.IsActive == True).one()
+             SP_MCSI_SellOut.IsActive == true()).one()
 
     # attachments
     atts = model.query(SP_SellOutUploadFile)\
@@ -642,7 +848,7 @@ def upload_detail(upload_id: int):
         "ActedAtLocal": _fmt_dt_local(t.ActedAt)
     } for t in trail]
 
-    return jsonify(ok=True, item={
+    return ojson({"ok": True, "item": {
         "UploadID": u.UploadID,
         "Status": u.Status,
         "Brand": u.Brand,
@@ -663,7 +869,7 @@ def upload_detail(upload_id: int):
         "TotalSellOutQty": float(agg.TotalSellOutQty or 0.0),
         "Attachments": attachments,
         "Approvals": approvals
-    })
+    }})
 
 # ---- choices for filters (brands, customers, statuses) ----
 @bp.route("/choices", methods=["GET"])
@@ -731,7 +937,7 @@ def choices():
         for c in customers:
             c["pending"] = cust_counts.get(c["id"], 0)
 
-    return jsonify({
+    return ojson({
         "brands": brands,
         "customers": customers,
         # extras that are useful for dropdowns (your UI can ignore if unused)
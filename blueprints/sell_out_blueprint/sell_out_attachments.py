@@ -1,38 +1,384 @@
 # blueprints/sell_out_attachments.py (or inside your existing sell_out blueprint)
-from flask import Blueprint, request, send_from_directory, current_app, abort, Response
+from flask import Blueprint, request, send_from_directory, current_app, abort, Response, jsonify
 from werkzeug.utils import secure_filename
 from uuid import uuid4
+from urllib.parse import quote
+from sqlalchemy import event, select, insert, distinct
 import os
 import re
+import base64
+import hashlib
+import json
+import time
+import logging
+import threading
+import mimetypes
 from config import STATIC_DIR, BASE_DIR
-from models import model, SP_Customer, SP_SellOutUploadFile, SP_SellOutUploads  # to resolve customer_id → name
+from models import model, Session, SP_Customer, SP_SellOutUploadFile, SP_SellOutUploads  # to resolve customer_id → name
+from utils.sellout_summary import refresh_upload_summary
+from utils import background
 
 bp = Blueprint("sell_out_attachments", __name__, url_prefix="/sell_out_uploads")
+log = logging.getLogger(__name__)
 
 # ---- config ----
-ALLOWED_EXTS = {"pdf", "png", "jpg", "jpeg", "gif", "webp", "tif", "tiff", "xlsx", "xls", 'CSV'}
+# lower-case only: _allowed() lower-cases the extension before the lookup
+ALLOWED_EXTS = frozenset({"pdf", "png", "jpg", "jpeg", "gif", "webp", "tif", "tiff", "xlsx", "xls", "csv"})
 UPLOAD_ROOT  = os.path.normpath(os.path.join(STATIC_DIR, "uploads"))
+_UPLOAD_ROOT_REAL = os.path.realpath(UPLOAD_ROOT)
+CHUNK_SIZE   = 1 << 20   # 1MB write chunks for streamed uploads
+MAX_REVERT_BATCH = 500
+ATTACHMENT_MAX_AGE = 3600
+# rows not yet in the DB ("." keeps it out of the <slug>/ namespace served by fp_load)
+PENDING_DIR  = os.path.join(UPLOAD_ROOT, ".pending")
+RECONCILE_EVERY_SECS = 600
+CUSTOMER_NAME_TTL = 300   # seconds
+CUSTOMER_NAME_MAX = 1024
+_CUSTOMER_NAMES: dict[int, tuple[str, float]] = {}   # CustomerID -> (CustName, stamp)
+_last_reconcile = 0.0
+# serverId is "<slug>/<shard>/<uid>__<secure_filename>" (older ones: "<slug>/<uuid hex>__<name>")
+_SAFE_ID = re.compile(r"^[a-z0-9\-]+/(?:[a-z2-7]{2}/)?[A-Za-z0-9_.\-]+$")
+
+class _SlugTable(dict):
+    # anything outside [a-z0-9] (incl. non-latin code points) becomes "-"
+    def __missing__(self, key):
+        return "-"
+
+_SLUG_TABLE = _SlugTable({ord(c): c for c in "abcdefghijklmnopqrstuvwxyz0123456789"})
 
 def _slug(s: str) -> str:
-    s = s.strip().lower()
-    s = re.sub(r"[^a-z0-9]+", "-", s)
-    return re.sub(r"-+", "-", s).strip("-") or "unknown"
+    s = s.strip().lower().translate(_SLUG_TABLE)
+    # collapse runs of "-" and trim both ends in one pass
+    return "-".join(filter(None, s.split("-"))) or "unknown"
 
 def _allowed(filename: str) -> bool:
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTS
+    _, sep, ext = filename.rpartition(".")
+    return bool(sep) and ext.lower() in ALLOWED_EXTS
+
+def _safe_path(server_id: str) -> str | None:
+    """Absolute path for a serverId, or None if it's malformed or escapes UPLOAD_ROOT."""
+    if not server_id or not _SAFE_ID.match(server_id):
+        return None
+    abs_path = os.path.realpath(os.path.join(_UPLOAD_ROOT_REAL, server_id))
+    if os.path.commonpath([abs_path, _UPLOAD_ROOT_REAL]) != _UPLOAD_ROOT_REAL:
+        return None
+    # must still be a file at the expected depth, not a folder itself ("slug/..", "slug/.")
+    depth = server_id.count("/")
+    top = abs_path
+    for _ in range(depth + 1):
+        top = os.path.dirname(top)
+    if top != _UPLOAD_ROOT_REAL:
+        return None
+    return abs_path
+
+_KNOWN_DIRS: set[str] = set()
+_KNOWN_DIRS_LOCK = threading.Lock()
 
 def _ensure_dir(p: str):
+    # folders are never removed by the app, so one makedirs per path per process is enough
+    if p in _KNOWN_DIRS:
+        return
     os.makedirs(p, exist_ok=True)
+    with _KNOWN_DIRS_LOCK:
+        _KNOWN_DIRS.add(p)
+
+def _customer_name(cid: int) -> str | None:
+    """
+    CustName for folder naming, cached for CUSTOMER_NAME_TTL seconds. Misses
+    aren't cached, so a customer created later is picked up on its first upload.
+    """
+    hit = _CUSTOMER_NAMES.get(cid)
+    now = time.monotonic()
+    if hit and now - hit[1] <= CUSTOMER_NAME_TTL:
+        return hit[0]
+    # read past the per-user RBAC criteria (plain connection, not ORM)
+    name = model.connection().execute(
+        select(SP_Customer.CustName).where(SP_Customer.CustomerID == cid)
+    ).scalar()
+    if name is not None:
+        if len(_CUSTOMER_NAMES) >= CUSTOMER_NAME_MAX:
+            _CUSTOMER_NAMES.clear()
+        _CUSTOMER_NAMES[cid] = (name, now)
+    return name
+
+@event.listens_for(SP_Customer, "after_insert")
+@event.listens_for(SP_Customer, "after_update")
+@event.listens_for(SP_Customer, "after_delete")
+def _invalidate_customer_names(mapper, connection, target):
+    # ORM writes (customer-mgmt screens) drop the cache right away; Core/raw
+    # writes such as the C2H load in main.py are picked up via the TTL
+    _CUSTOMER_NAMES.clear()
 
 def _resolve_customer_name(customer_id: int | None, customer_name: str | None) -> str:
     if customer_name:
         return customer_name
     if customer_id:
-        row = model.query(SP_Customer.CustName).filter(SP_Customer.CustomerID == customer_id).scalar()
+        row = _customer_name(customer_id)
         if row:
             return row
     return "UnknownCustomer"
 
+def _upload_with_customer(upload_id: int):
+    """(UploadID, CustomerID, CustName) for an upload in one round-trip, or None if not found/visible."""
+    return (model.query(SP_SellOutUploads.UploadID, SP_Customer.CustomerID, SP_Customer.CustName)
+                 .join(SP_Customer, SP_Customer.CustomerID == SP_SellOutUploads.CustomerID)
+                 .filter(SP_SellOutUploads.UploadID == upload_id)
+                 .first())
+
+def _customer_dir(upload_row, params=None) -> tuple[str, str]:
+    """Resolve the posted customer to (slug, folder) and make sure the folder exists."""
+    params        = request.form if params is None else params
+    customer_id   = params.get("customer_id", type=int)
+    customer_name = (params.get("customer_name") or "").strip() or None
+    if not customer_name and customer_id in (None, upload_row.CustomerID):
+        customer_name = upload_row.CustName   # already fetched with the upload
+    cust_name     = _resolve_customer_name(customer_id, customer_name)
+    cust_slug     = _slug(cust_name)
+
+    save_dir = os.path.join(UPLOAD_ROOT, cust_slug)
+    _ensure_dir(save_dir)
+    return cust_slug, save_dir
+
+_TMPFILE_OK = hasattr(os, "O_TMPFILE")
+
+def _open_tmp(save_path: str) -> tuple[int, str | None]:
+    """
+    Anonymous O_TMPFILE in the target folder (Linux >= 3.11) -> (fd, None); it has
+    no name until published, so a killed request leaves nothing behind.
+    Elsewhere, or if the filesystem refuses it: a "<name>.part" file -> (fd, part_path).
+    """
+    global _TMPFILE_OK
+    if _TMPFILE_OK:
+        try:
+            return os.open(os.path.dirname(save_path), os.O_TMPFILE | os.O_RDWR, 0o644), None
+        except OSError:
+            _TMPFILE_OK = False
+    part = f"{save_path}.part"
+    return os.open(part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644), part
+
+def _publish_tmp(fd: int, save_path: str):
+    """Give an O_TMPFILE its name (linkat AT_SYMLINK_FOLLOW via /proc)."""
+    global _TMPFILE_OK
+    try:
+        os.link(f"/proc/self/fd/{fd}", save_path)
+        return
+    except OSError:
+        # no /proc or linkat refused (containers, some sandboxes): copy out once
+        # and stop using O_TMPFILE in this process
+        _TMPFILE_OK = False
+    part = f"{save_path}.part"
+    os.lseek(fd, 0, os.SEEK_SET)
+    try:
+        with open(part, "wb") as out:
+            while True:
+                chunk = os.read(fd, CHUNK_SIZE)
+                if not chunk:
+                    break
+                out.write(chunk)
+        os.replace(part, save_path)
+    except BaseException:
+        try:
+            os.remove(part)
+        except OSError:
+            pass
+        raise
+
+def _drop_cache(fd: int, size_bytes: int):
+    """
+    Attachments are written once and rarely re-read: tell the kernel it can drop
+    their pages so they don't crowd out the page cache (no-op where unsupported).
+    """
+    if hasattr(os, "posix_fadvise") and size_bytes:
+        try:
+            os.posix_fadvise(fd, 0, size_bytes, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+def _write_stream(stream, save_path: str) -> tuple[int, str]:
+    """
+    Copy a byte stream to save_path in CHUNK_SIZE pieces, hashing as it goes.
+    The file only appears under save_path once fully written.
+    Returns (bytes written, BLAKE2b-128 hex digest).
+    """
+    size_bytes = 0
+    h = hashlib.blake2b(digest_size=16)
+    fd, part = _open_tmp(save_path)
+    try:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(fd, view):]
+            size_bytes += len(chunk)
+        if part is None:
+            _publish_tmp(fd, save_path)
+        _drop_cache(fd, size_bytes)
+    except BaseException:
+        os.close(fd)
+        if part is not None:
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+        raise
+    os.close(fd)
+    if part is not None:
+        os.replace(part, save_path)
+    return size_bytes, h.hexdigest()
+
+def _dedupe_file(cust_slug: str, content_hash: str, save_path: str):
+    """
+    If this customer already has a file with the same bytes, swap the fresh copy
+    for a hard link to it (same inode; each serverId can still be reverted on its own).
+    Best effort: any failure just keeps the copy we wrote.
+    """
+    candidates = model.connection().execute(
+        select(SP_SellOutUploadFile.ServerID)
+        .where(SP_SellOutUploadFile.ContentHash == content_hash,
+               SP_SellOutUploadFile.ServerID.like(f"{cust_slug}/%"))
+        .limit(5)
+    ).scalars().all()
+    for sid in candidates:
+        existing = _safe_path(sid)
+        if not existing or not os.path.isfile(existing):
+            continue
+        tmp = f"{save_path}.lnk"
+        try:
+            os.link(existing, tmp)
+            os.replace(tmp, save_path)
+            return
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return   # cross-device / no hardlink support: keep the copy
+
+def _new_server_fn(save_dir: str, orig_name: str) -> tuple[str, str]:
+    """
+    Unique "<shard>/<uid>__<name>" under save_dir plus its absolute path.
+    uid is the uuid4 in unpadded lower-case base32 (26 chars, safe on
+    case-insensitive filesystems); its first two chars shard the customer
+    folder into <=1024 subfolders so no single directory grows unbounded.
+    """
+    uid   = base64.b32encode(uuid4().bytes).decode("ascii").rstrip("=").lower()
+    shard = uid[:2]
+    _ensure_dir(os.path.join(save_dir, shard))
+    server_fn = f"{shard}/{uid}__{orig_name}"
+    return server_fn, os.path.join(save_dir, shard, f"{uid}__{orig_name}")
+
+def _store_file(f, upload_id: int, cust_slug: str, save_dir: str) -> dict:
+    """Write one FileStorage to disk; returns the SP_SellOutUploadFile row mapping."""
+    # Unique file name
+    orig_name = secure_filename(f.filename)
+    server_fn, save_path = _new_server_fn(save_dir, orig_name)
+    size_bytes, content_hash = _write_stream(f.stream, save_path)
+    _dedupe_file(cust_slug, content_hash, save_path)
+
+    # FilePond expects a plain text ID; we’ll encode relative path "<slug>/<shard>/<filename>"
+    return dict(
+        UploadID     = upload_id,
+        ServerID     = f"{cust_slug}/{server_fn}",
+        OriginalName = orig_name,
+        MimeType     = f.mimetype or None,
+        SizeBytes    = size_bytes,
+        ContentHash  = content_hash,
+        UploadedBy   = (request.form.get("actor") or request.headers.get("X-User") or None),
+    )
+
+def _pending_path(server_id: str) -> str:
+    return os.path.join(PENDING_DIR, server_id.replace("/", "__") + ".json")
+
+def create_attachment_row(row: dict):
+    """
+    Background: insert one SP_SellOutUploadFile row (+ summary refresh), then
+    drop its pending marker. On failure the marker stays for the reconciler.
+    A revert removes the marker before anything else, so the marker is
+    re-checked before and after the commit to avoid leaving an orphan row.
+    """
+    marker = _pending_path(row["ServerID"])
+    if not os.path.isfile(os.path.join(UPLOAD_ROOT, row["ServerID"])):
+        # reverted before we got to it
+        try:
+            os.remove(marker)
+        except OSError:
+            pass
+        return
+
+    db = Session()
+    try:
+        dup = db.query(SP_SellOutUploadFile.FileID).filter(SP_SellOutUploadFile.ServerID == row["ServerID"]).first()
+        if dup is None:
+            db.add(SP_SellOutUploadFile(**row))
+            refresh_upload_summary(db, [row["UploadID"]])
+            db.flush()
+            if not os.path.exists(marker):
+                db.rollback()   # reverted while we were inserting
+                return
+            db.commit()
+            if not os.path.exists(marker):
+                # the revert landed between the check and the commit; its DELETE
+                # may have run before our row existed, so take the row back out
+                db.query(SP_SellOutUploadFile)\
+                  .filter(SP_SellOutUploadFile.ServerID == row["ServerID"])\
+                  .delete(synchronize_session=False)
+                refresh_upload_summary(db, [row["UploadID"]])
+                db.commit()
+                return
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    try:
+        os.remove(marker)
+    except OSError:
+        pass
+
+def reconcile_pending_attachments(min_age_secs: int = 60):
+    """Retry rows whose background insert never finished (worker crash, DB outage, restart)."""
+    try:
+        names = os.listdir(PENDING_DIR)
+    except FileNotFoundError:
+        return
+    cutoff = time.time() - min_age_secs
+    for name in names:
+        marker = os.path.join(PENDING_DIR, name)
+        try:
+            if os.path.getmtime(marker) > cutoff:
+                continue
+            with open(marker, encoding="utf-8") as fh:
+                row = json.load(fh)
+        except (OSError, ValueError):
+            continue
+        if background.is_inflight(("attachment_row", row.get("ServerID"))):
+            continue
+        try:
+            create_attachment_row(row)
+        except Exception:
+            log.exception("Reconcile failed for %s", row.get("ServerID"))
+
+def _queue_attachment_row(row: dict):
+    """
+    The file is already on disk, so the DB row doesn't have to hold up the response:
+    write a small pending marker (durable hand-off) and let the shared pool insert it.
+    Piggy-backs a throttled reconcile pass for markers left behind.
+    """
+    global _last_reconcile
+    _ensure_dir(PENDING_DIR)
+    with open(_pending_path(row["ServerID"]), "w", encoding="utf-8") as fh:
+        json.dump(row, fh)
+    background.submit(create_attachment_row, row, key=("attachment_row", row["ServerID"]))
+
+    now = time.monotonic()
+    if now - _last_reconcile >= RECONCILE_EVERY_SECS:
+        _last_reconcile = now
+        background.submit(reconcile_pending_attachments, key="attachment_reconcile")
+
 # === FilePond: PROCESS ===
 @bp.route("/upload-attachment", methods=["POST"])
 def fp_process():
@@ -41,7 +387,7 @@ def fp_process():
       - file field name: 'filepond'
       - either 'customer_id' (int) or 'customer_name' in form data
     Returns:
-      - plain text "serverId" that FilePond stores (we use "<slug>/<filename>")
+      - plain text "serverId" that FilePond stores (we use "<slug>/<shard>/<filename>")
     """
     f = request.files.get("filepond")
     if not f or f.filename == "":
@@ -54,48 +400,115 @@ def fp_process():
     upload_id = request.form.get("upload_id", type=int)
     if not upload_id:
         return ("Missing upload_id", 400)
-    # Validate UploadID exists (and is yours, if you enforce ownership)
-    exists = model.query(SP_SellOutUploads.UploadID).filter(SP_SellOutUploads.UploadID == upload_id).scalar()
-    if not exists:
+    # Validate UploadID exists (and is yours, if you enforce ownership); brings the customer name along
+    upload_row = _upload_with_customer(upload_id)
+    if upload_row is None:
         return ("Invalid upload_id", 404)
     
     # Resolve customer name and make folder
-    customer_id   = request.form.get("customer_id", type=int)
-    customer_name = (request.form.get("customer_name") or "").strip() or None
-    cust_name     = _resolve_customer_name(customer_id, customer_name)
-    cust_slug     = _slug(cust_name)
+    cust_slug, save_dir = _customer_dir(upload_row)
+    row = _store_file(f, upload_id, cust_slug, save_dir)
+    _queue_attachment_row(row)
 
-    save_dir = os.path.join(UPLOAD_ROOT, cust_slug)
-    _ensure_dir(save_dir)
+    return Response(row["ServerID"], mimetype="text/plain")
 
-    # Unique file name
-    orig_name = secure_filename(f.filename)
-    uid       = uuid4().hex
-    server_fn = f"{uid}__{orig_name}"
-    save_path = os.path.join(save_dir, server_fn)
-    f.save(save_path)
+# === PROCESS (raw body, no multipart parsing) ===
+@bp.route("/upload-attachment/stream", methods=["POST", "PUT"])
+def fp_process_stream():
+    """
+    The request body *is* the file; nothing is spooled by Werkzeug's multipart
+    parser, bytes go straight from request.stream to disk in 1MB chunks.
+    Expects (query string):
+      - upload_id, and either customer_id or customer_name
+      - filename (or the 'Upload-Name' header FilePond sends on chunked uploads)
+    Returns the same plain text "serverId" as fp_process.
+    """
+    filename = request.args.get("filename") or request.headers.get("Upload-Name") or ""
+    if not filename:
+        return ("Missing filename", 400)
 
-    # FilePond expects a plain text ID; we’ll encode relative path "<slug>/<filename>"
-    server_id = f"{cust_slug}/{server_fn}"
-    
-    try:
-        size_bytes = os.path.getsize(save_path)
-    except Exception:
-        size_bytes = None
+    if not _allowed(filename):
+        return ("Unsupported file type", 415)
 
-    model.add(SP_SellOutUploadFile(
+    upload_id = request.args.get("upload_id", type=int)
+    if not upload_id:
+        return ("Missing upload_id", 400)
+    upload_row = _upload_with_customer(upload_id)
+    if upload_row is None:
+        return ("Invalid upload_id", 404)
+
+    cust_slug, save_dir = _customer_dir(upload_row, request.args)
+
+    orig_name = secure_filename(filename)
+    server_fn, save_path = _new_server_fn(save_dir, orig_name)
+    size_bytes, content_hash = _write_stream(request.stream, save_path)
+    _dedupe_file(cust_slug, content_hash, save_path)
+
+    mimetype = request.mimetype
+    if not mimetype or mimetype == "application/octet-stream":
+        mimetype = mimetypes.guess_type(orig_name)[0]
+
+    server_id = f"{cust_slug}/{server_fn}"
+    _queue_attachment_row(dict(
         UploadID     = upload_id,
         ServerID     = server_id,
         OriginalName = orig_name,
-        MimeType     = f.mimetype or None,
+        MimeType     = mimetype or None,
         SizeBytes    = size_bytes,
-        UploadedBy   = (request.form.get("actor") or request.headers.get("X-User") or None),
+        ContentHash  = content_hash,
+        UploadedBy   = (request.args.get("actor") or request.headers.get("X-User") or None),
     ))
-    model.commit()
 
-    
     return Response(server_id, mimetype="text/plain")
 
+# === FilePond: PROCESS (several files in one POST) ===
+@bp.route("/upload-attachment/batch", methods=["POST"])
+def fp_process_batch():
+    """
+    Same form fields as fp_process, but any number of files under 'filepond[]'
+    (or repeated 'filepond'). All rows go in with one executemany + one commit.
+    Returns JSON {"serverIds": [...], "fileIds": [...]} in the order the files were posted.
+    """
+    files = [f for f in (request.files.getlist("filepond[]") or request.files.getlist("filepond"))
+             if f and f.filename]
+    if not files:
+        return ("No file uploaded", 400)
+
+    bad = [f.filename for f in files if not _allowed(f.filename)]
+    if bad:
+        return (f"Unsupported file type: {', '.join(bad)}", 415)
+
+    upload_id = request.form.get("upload_id", type=int)
+    if not upload_id:
+        return ("Missing upload_id", 400)
+    upload_row = _upload_with_customer(upload_id)
+    if upload_row is None:
+        return ("Invalid upload_id", 404)
+
+    cust_slug, save_dir = _customer_dir(upload_row)
+    rows = [_store_file(f, upload_id, cust_slug, save_dir) for f in files]
+
+    try:
+        # one executemany that also hands back the new FileIDs, in the order posted
+        file_ids = model.execute(
+            insert(SP_SellOutUploadFile).returning(SP_SellOutUploadFile.FileID, sort_by_parameter_order=True),
+            rows,
+        ).scalars().all()
+        refresh_upload_summary(model, [upload_id])
+        model.commit()
+    except Exception as e:
+        model.rollback()
+        # don't leave orphans on disk for rows that never made it in
+        for r in rows:
+            try:
+                os.remove(os.path.join(UPLOAD_ROOT, r["ServerID"]))
+            except OSError:
+                pass
+        current_app.logger.exception("Failed to save attachment batch")
+        return (str(e), 500)
+
+    return jsonify(serverIds=[r["ServerID"] for r in rows], fileIds=file_ids)
+
 # === FilePond: REVERT (delete by serverId) ===
 @bp.route("/upload-attachment/revert", methods=["DELETE", "POST"])
 def fp_revert():
@@ -107,9 +520,14 @@ def fp_revert():
     if not server_id:
         return ("Missing serverId", 400)
 
-    # server_id pattern: "<slug>/<filename>"
-    rel_path = server_id.replace("..", "")
-    abs_path = os.path.join(UPLOAD_ROOT, rel_path)
+    # server_id pattern: "<slug>/[<shard>/]<filename>"
+    abs_path = _safe_path(server_id)
+    if abs_path is None:
+        return ("Invalid serverId", 400)
+    try:
+        os.remove(_pending_path(server_id))   # row may still be queued
+    except OSError:
+        pass
     if os.path.isfile(abs_path):
         try:
             os.remove(abs_path)
@@ -119,7 +537,10 @@ def fp_revert():
     
      # delete DB row
     try:
+        upload_ids = [uid for (uid,) in model.query(SP_SellOutUploadFile.UploadID)
+                                             .filter(SP_SellOutUploadFile.ServerID == server_id).all()]
         model.query(SP_SellOutUploadFile).filter(SP_SellOutUploadFile.ServerID == server_id).delete()
+        refresh_upload_summary(model, upload_ids)
         model.commit()
     except Exception as e:
         model.rollback()
@@ -130,20 +551,94 @@ def fp_revert():
     # FilePond expects 200 with empty body on success
     return ("", 200)
 
+# === REVERT (many serverIds, e.g. form cancel) ===
+@bp.route("/upload-attachment/revert-batch", methods=["DELETE", "POST"])
+def fp_revert_batch():
+    """
+    JSON body {"serverIds": [...]}. Unlinks each file, then removes all rows
+    with one DELETE ... WHERE ServerID IN (...) and one commit.
+    """
+    data = request.get_json(silent=True) or {}
+    server_ids = list(dict.fromkeys(str(x).strip() for x in (data.get("serverIds") or []) if x))
+    if not server_ids:
+        return jsonify(ok=False, error="Missing serverIds"), 400
+    if len(server_ids) > MAX_REVERT_BATCH:
+        return jsonify(ok=False, error=f"Too many serverIds (max {MAX_REVERT_BATCH})"), 413
+
+    paths = {sid: _safe_path(sid) for sid in server_ids}
+    bad = [sid for sid, pth in paths.items() if pth is None]
+    if bad:
+        return jsonify(ok=False, error="Invalid serverId", serverIds=bad), 400
+
+    failed = []
+    for sid, abs_path in paths.items():
+        try:
+            os.remove(_pending_path(sid))
+        except OSError:
+            pass
+        try:
+            os.remove(abs_path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            current_app.logger.exception("Failed to delete uploaded file %s", sid)
+            failed.append(sid)
+
+    done = [sid for sid in server_ids if sid not in failed]
+    try:
+        upload_ids = [uid for (uid,) in model.query(distinct(SP_SellOutUploadFile.UploadID))
+                                             .filter(SP_SellOutUploadFile.ServerID.in_(done)).all()]
+        deleted = (model.query(SP_SellOutUploadFile)
+                        .filter(SP_SellOutUploadFile.ServerID.in_(done))
+                        .delete(synchronize_session=False)) if done else 0
+        refresh_upload_summary(model, upload_ids)
+        model.commit()
+    except Exception as e:
+        model.rollback()
+        current_app.logger.exception("Failed to delete DB rows for attachment batch")
+        return jsonify(ok=False, error=str(e)), 500
+
+    return jsonify(ok=not failed, deleted=deleted, failed=failed), (500 if failed else 200)
+
 # === FilePond: LOAD (serve the file by serverId) ===
 @bp.route("/upload-attachment/load/<path:server_id>", methods=["GET"])
 def fp_load(server_id):
     """
     Serve the file back to FilePond by the serverId we previously returned.
+    With USE_X_SENDFILE the front server streams the bytes; otherwise Werkzeug
+    hands the open file to wsgi.file_wrapper, which gunicorn turns into
+    os.sendfile() on the client socket. Only the dev server (no file_wrapper)
+    falls back to Werkzeug's read/write loop; a WSGI app can't reach the
+    socket fd to sendfile itself, so keep the path-based send so the server can.
+    Conditional so re-opens get 304s instead of the full body.
+
+    With ATTACHMENT_ACCEL_PREFIX configured, Flask only validates the id and
+    nginx serves the bytes from its internal location (X-Accel-Redirect).
     """
-    rel_path = server_id.replace("..", "")
-    parts = rel_path.split("/", 1)
-    if len(parts) != 2:
+    abs_path = _safe_path(server_id)
+    if abs_path is None:
         abort(404)
 
-    cust_slug, filename = parts
-    directory = os.path.join(UPLOAD_ROOT, cust_slug)
-    return send_from_directory(directory, filename, as_attachment=False)
+    accel = current_app.config.get("ATTACHMENT_ACCEL_PREFIX")
+    if accel:
+        rel_path = os.path.relpath(abs_path, _UPLOAD_ROOT_REAL).replace(os.sep, "/")
+        resp = Response(headers={
+            "X-Accel-Redirect": f"{accel.rstrip('/')}/{quote(rel_path)}",
+            "Content-Type": mimetypes.guess_type(abs_path)[0] or "application/octet-stream",
+        })
+        resp.cache_control.private = True
+        resp.cache_control.max_age = ATTACHMENT_MAX_AGE
+        return resp
+
+    directory, filename = os.path.split(abs_path)
+    # serverIds are uuid-named and never rewritten, so the browser can keep them;
+    # conditional=True also answers Range requests (PDF.js page fetches) and 304s
+    resp = send_from_directory(directory, filename, as_attachment=False,
+                               conditional=True, etag=True, max_age=ATTACHMENT_MAX_AGE)
+    resp.cache_control.public = False
+    resp.cache_control.private = True   # customer documents: browser cache only, not shared proxies
+    resp.headers["Accept-Ranges"] = "bytes"
+    return resp
 
 # === FilePond: FETCH (optional: proxy remote URLs) ===
 @bp.route("/upload-attachment/fetch/<path:url>", methods=["GET"])
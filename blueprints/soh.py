@@ -11,15 +11,18 @@ from openpyxl.styles.differential import DifferentialStyle
 from openpyxl.formatting import Rule
 
 from datetime import date, datetime
-try:
-    from zoneinfo import ZoneInfo
-except ImportError:
-    ZoneInfo = None
-import pandas as pd
-import hashlib, os
 from collections import defaultdict
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+try:
+    import pyarrow  # noqa: F401  (enables pandas' multithreaded CSV reader)
+    CSV_ENGINE = "pyarrow"
+except ImportError:  # optional: fall back to pandas' C parser
+    CSV_ENGINE = "c"
+import hashlib, os, time
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import func, text
+from sqlalchemy import event, exists, func, text, insert, select, bindparam
 
 from models import model
 from blueprints.sell_out_blueprint.sell_out import _resolve_sku_id  # reuse
@@ -31,6 +34,12 @@ from models import SP_SOH_Uploads, SP_SOH_Detail, SP_InventoryLedger  # <-- only
 from config import STATIC_DIR, BASE_DIR, TZ_RIYADH
 
 ALLOWED = {"xlsx","xls","csv"}
+IN_CHUNK = 1000   # stay well under SQL Server's 2100-parameter limit
+HASH_CHUNK = 1 << 20
+BRANDS_TTL = 300   # seconds
+
+_STATUS_IDS: dict[str, int] = {}
+_BRANDS_CACHE = {"stamp": float("-inf"), "names": (), "map": {}}
 
 
 bp = Blueprint("soh", __name__, static_folder=STATIC_DIR, url_prefix="/soh")
@@ -42,67 +51,131 @@ def _allowed(name:str)->bool:
     return "." in name and name.rsplit(".",1)[1].lower() in ALLOWED
 
 def _sha256_fs(fs) -> str:
+    # hash the upload stream in chunks instead of reading it into one bytes copy
     fs.stream.seek(0)
-    data = fs.read()          # IMPORTANT: read the FileStorage, not fs.stream
+    if hasattr(hashlib, "file_digest"):   # 3.11+
+        h = hashlib.file_digest(fs.stream, "sha256")
+    else:
+        h = hashlib.sha256()
+        for chunk in iter(lambda: fs.stream.read(HASH_CHUNK), b""):
+            h.update(chunk)
     fs.stream.seek(0)
-    return hashlib.sha256(data).hexdigest()
+    return h.hexdigest()
+
+# header synonym (lower-case) -> (canonical name, preference); when a sheet has
+# several synonyms of one column, the earliest in its list is the one renamed
+SYNONYM_TO_CANON = {
+    syn: (canon, rank)
+    for canon, syns in {
+        "Brand":       ["brand"],
+        "CustSKUCode": ["cust-sku","custsku","cust sku","custskucode"],
+        "MEC_SKU":     ["mec-sku","mec sku","articlecode","material","sku","mec"],
+        "SOHQty":      ["sohqty","qty","quantity","stockonhand"],
+        "RowNumber":   ["rownumber","row","#"],
+    }.items()
+    for rank, syn in enumerate(syns)
+}
 
 def _normalize_soh_columns(df: pd.DataFrame) -> pd.DataFrame:
-    rename_map, low = {}, {c.lower(): c for c in df.columns}
-    for k in ["brand"]: 
-        if k in low: rename_map[low[k]] = "Brand"; break
-    for k in ["cust-sku","custsku","cust sku","custskucode"]:
-        if k in low: rename_map[low[k]] = "CustSKUCode"; break
-    for k in ["mec-sku","mec sku","articlecode","material","sku","mec"]:
-        if k in low: rename_map[low[k]] = "MEC_SKU"; break
-    for k in ["sohqty","qty","quantity","stockonhand"]:
-        if k in low: rename_map[low[k]] = "SOHQty"; break
-    for k in ["rownumber","row","#"]:
-        if k in low: rename_map[low[k]] = "RowNumber"; break
-    return df.rename(columns=rename_map)
+    best = {}   # canonical -> (rank, original column)
+    for c in df.columns:
+        hit = SYNONYM_TO_CANON.get(c.lower())
+        if hit and (hit[0] not in best or hit[1] < best[hit[0]][0]):
+            best[hit[0]] = (hit[1], c)
+    return df.rename(columns={col: canon for canon, (_, col) in best.items()})
+
+def _read_xlsx_sheet(fs, sheet: str) -> pd.DataFrame:
+    """
+    Read one sheet (falling back to the first, like read_excel's default) with
+    openpyxl in read-only mode: rows are streamed from the zip instead of
+    building the whole workbook in memory first.
+    """
+    fs.stream.seek(0)
+    wb = load_workbook(fs.stream, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet] if sheet in wb.sheetnames else wb.worksheets[0]
+        ws.reset_dimensions()   # don't trust the stored <dimension>, some writers get it wrong
+        rows = ws.iter_rows(values_only=True)
+        header = next(rows, None) or ()
+        while header and header[-1] is None:
+            header = header[:-1]
+        header = [f"Unnamed: {i}" if h is None else str(h) for i, h in enumerate(header)]
+        width = len(header)
+        data = [(tuple(r) + (None,) * width)[:width] for r in rows]
+    finally:
+        wb.close()
+    # read_excel drops trailing blank rows; blank rows in between stay (as NaN)
+    while data and all(v is None for v in data[-1]):
+        data.pop()
+    return pd.DataFrame.from_records(data, columns=header).infer_objects()
 
 def _load_df(fs)->pd.DataFrame:
     ext = fs.filename.rsplit(".",1)[1].lower()
-    if ext in {"xlsx","xls"}:
+    if ext == "xlsx":
+        df = _read_xlsx_sheet(fs, "SOH")
+    elif ext == "xls":
         try:
             df = pd.read_excel(fs, sheet_name="SOH")
         except Exception:
             fs.stream.seek(0); df = pd.read_excel(fs)
     else:
-        df = pd.read_csv(fs)
+        fs.stream.seek(0)
+        df = pd.read_csv(fs.stream, engine=CSV_ENGINE)
     df.columns = [c.strip() for c in df.columns]
     return _normalize_soh_columns(df)
 
-def _article_exists_in_mCSI_exact(article_name: str) -> bool:
-    if not article_name: 
-        return False
+def _existing_mcsi_articles(articles) -> set[str]:
+    """
+    Lower-cased subset of `articles` that exist in MCSI (TB_WH_B2B_SO).
+    One IN-query per IN_CHUNK names instead of a TOP 1 probe per row; plain
+    `Article IN (...)` keeps the column sargable (the old LOWER() on both
+    sides did not) and the CI collation still matches regardless of case.
+    """
+    names = sorted({str(a).strip() for a in articles if a is not None and str(a).strip()})
+    if not names:
+        return set()
     sql = text("""
-        SELECT TOP 1 1
+        SELECT DISTINCT Article
         FROM TB_WH_B2B_SO WITH (NOLOCK)
-        WHERE LOWER(Article) = LOWER(:name)
-    """)
-    row = model.execute(sql, {"name": article_name.strip()}).first()
-    return bool(row)
-
-def _get_or_create_sku(brand: str, article: str) -> int | None:
-    if not brand or not article:
-        return None
-    # Try exact (brand + article) match in SP_SKU
-    sku = (model.query(SP_SKU)
-           .filter(SP_SKU.Brand==brand.strip(),
-                   SP_SKU.ArticleCode==article.strip()) 
-           .first())
-    if sku:
-        return int(sku.SKU_ID)
-
-    # Create if not exists
-    sku = SP_SKU(
-        Brand = brand.strip(),
-        ArticleCode   = article.strip(),
-    )
-    model.add(sku)
-    model.flush()
-    return int(sku.SKU_ID)
+        WHERE Article IN :names
+    """).bindparams(bindparam("names", expanding=True))
+    found = set()
+    for i in range(0, len(names), IN_CHUNK):
+        found.update((row[0] or "").lower() for row in model.execute(sql, {"names": names[i:i + IN_CHUNK]}))
+    return found
+
+def _resolve_skus(pairs) -> dict[tuple[str, str], int]:
+    """
+    Map (brand, article) -> SKU_ID for all pairs in a few IN-queries, creating
+    the missing SP_SKU rows in one multi-row INSERT. Keys are matched
+    case-insensitively, like the SQL Server collation the per-row lookup relied on.
+    """
+    pairs = {(b.strip(), a.strip()) for b, a in pairs if b and a and b.strip() and a.strip()}
+    if not pairs:
+        return {}
+
+    found: dict[tuple[str, str], int] = {}
+    articles = sorted({a for _, a in pairs})
+    for i in range(0, len(articles), IN_CHUNK):
+        for brand, art, sku_id in (model.query(SP_SKU.Brand, SP_SKU.ArticleCode, SP_SKU.SKU_ID)
+                                        .filter(SP_SKU.ArticleCode.in_(articles[i:i + IN_CHUNK]))):
+            found[((brand or "").casefold(), (art or "").casefold())] = int(sku_id)
+
+    out, missing = {}, []
+    for b, a in pairs:
+        sku_id = found.get((b.casefold(), a.casefold()))
+        if sku_id is None:
+            missing.append((b, a))
+        else:
+            out[(b, a)] = sku_id
+
+    if missing:
+        new_ids = model.execute(
+            insert(SP_SKU).returning(SP_SKU.SKU_ID, sort_by_parameter_order=True),
+            [{"Brand": b, "ArticleCode": a} for b, a in missing],
+        ).scalars().all()
+        out.update(zip(missing, (int(x) for x in new_ids)))
+    return out
 
 def _ensure_customer_sku_map(customer_id: int, sku_id: int, cust_sku_code: str | None):
     """
@@ -136,13 +209,47 @@ def _ensure_customer_sku_map(customer_id: int, sku_id: int, cust_sku_code: str |
     ))
 
 def _get_active_status_id():
+    # status ids never change once created; only cache committed rows, a
+    # freshly flushed one could still be rolled back with the upload
+    if "Active" in _STATUS_IDS:
+        return _STATUS_IDS["Active"]
     row = model.query(SP_Status).filter(SP_Status.StatusName == "Active").first()
     if row:
+        _STATUS_IDS["Active"] = row.StatusID
         return row.StatusID
     st = SP_Status(StatusName="Active")
     model.add(st); model.flush()
     return st.StatusID
 
+def _refresh_brands() -> None:
+    """
+    Re-read the brand master at most every BRANDS_TTL seconds. RTOS_Brands is
+    maintained outside this app, hence the TTL; ORM writes to Brands still
+    drop the cache right away.
+    """
+    now = time.monotonic()
+    if now - _BRANDS_CACHE["stamp"] > BRANDS_TTL:
+        names = sorted({(b.BrandName or "").strip() for b in model.query(Brands).all() if (b.BrandName or "").strip()})
+        _BRANDS_CACHE["names"] = tuple(names)
+        _BRANDS_CACHE["map"] = { n.lower(): n.upper() for n in names }
+        _BRANDS_CACHE["stamp"] = now
+
+def _get_brand_lower_map() -> dict[str, str]:
+    """{lowercase: canonical UPPER} for upload validation."""
+    _refresh_brands()
+    return _BRANDS_CACHE["map"]
+
+def _get_brand_names() -> tuple[str, ...]:
+    """Sorted, stripped brand names as shown in the template dropdown."""
+    _refresh_brands()
+    return _BRANDS_CACHE["names"]
+
+@event.listens_for(Brands, "after_insert")
+@event.listens_for(Brands, "after_update")
+@event.listens_for(Brands, "after_delete")
+def _invalidate_brands(mapper, connection, target):
+    _BRANDS_CACHE["stamp"] = float("-inf")
+
 
 
 @bp.route("/choices", methods=["GET"])
@@ -154,21 +261,12 @@ def choices():
     # brands = [{"name": b[0]} for b in model.query(Brands.BrandName).distinct().all() if b[0]]
     return jsonify({"customers": customers})
 
-@bp.route("/template", methods=["GET"])
-def template():
-    customer_id = request.args.get("customer_id", type=int)
-
-    cust_code = None
-    if customer_id:
-        cust = model.query(SP_Customer).filter(SP_Customer.CustomerID == customer_id).first()
-        if cust:
-            cust_code = cust.CustCode
-
-    cust_part = cust_code if cust_code else f"CUST{customer_id or 'NA'}"
-    today_str = datetime.now().strftime("%d-%b-%Y").upper()
-    file_name = f"SOH_BY_BRAND_{cust_part}_{today_str}.xlsx"
-
-
+@lru_cache(maxsize=8)
+def _build_template_bytes(brands: tuple[str, ...]) -> bytes:
+    """
+    SOH upload template (xlsx bytes) with a Brand dropdown over `brands`.
+    Keyed on the brand tuple, so a changed brand list simply builds a new entry.
+    """
     # 1) Base workbook via pandas
     df = pd.DataFrame(columns=["Brand", "Cust-SKU", "MEC-SKU", "SOHQty"])
     bio = BytesIO()
@@ -180,10 +278,6 @@ def template():
     wb = load_workbook(bio)
     ws = wb["SOH"]
 
-    # Fetch + sanitize brands
-    raw = model.query(Brands).order_by(Brands.BrandName.asc()).all()
-    brands = sorted({(b.BrandName or "").strip() for b in raw if (b.BrandName or "").strip()})
-
     if brands:
         # 2a) Put brands on a second sheet
         ws_list = wb.create_sheet("Lists")
@@ -224,10 +318,28 @@ def template():
     ws.column_dimensions["C"].width = 18
     ws.column_dimensions["D"].width = 12
 
-    # 3) Return the enriched workbook
     out = BytesIO()
     wb.save(out)
-    out.seek(0)
+    return out.getvalue()
+
+
+@bp.route("/template", methods=["GET"])
+def template():
+    customer_id = request.args.get("customer_id", type=int)
+
+    cust_code = None
+    if customer_id:
+        cust = model.query(SP_Customer).filter(SP_Customer.CustomerID == customer_id).first()
+        if cust:
+            cust_code = cust.CustCode
+
+    cust_part = cust_code if cust_code else f"CUST{customer_id or 'NA'}"
+    today_str = datetime.now().strftime("%d-%b-%Y").upper()
+    file_name = f"SOH_BY_BRAND_{cust_part}_{today_str}.xlsx"
+
+
+    # the workbook only depends on the brand list, so it is built once per list
+    out = BytesIO(_build_template_bytes(_get_brand_names()))
     return send_file(
         out,  # IMPORTANT: return the enriched buffer
         as_attachment=True,
@@ -236,28 +348,26 @@ def template():
     )
 
 
-def _get_prior_active_qty_for_day(customer_id:int, brand:str|None, sku_id:int, soh_date:date) -> float:
+def _get_prior_active_qtys(customer_id:int, soh_date:date) -> dict[tuple[str, int], float]:
     """
-    Read the prior 'active' snapshot qty for this (customer, brand?, sku, date).
-    If multiple older headers existed (shouldn't), prefer the latest via upload id.
+    Prior 'active' snapshot qty per (brand, sku) for this customer+date, in one query.
+    If multiple older headers existed (shouldn't), the latest upload id wins.
     """
-    q = (model.query(SP_SOH_Detail.SOHQty)
-         .join(SP_SOH_Uploads, SP_SOH_Uploads.SOHUploadID==SP_SOH_Detail.SOHUploadID)
-         .filter(SP_SOH_Uploads.CustomerID==customer_id,
-                 SP_SOH_Detail.SKU_ID==sku_id,
-                 SP_SOH_Detail.SOHDate==soh_date,
-                 SP_SOH_Detail.IsActive==True))
-    if brand is not None:
-        q = q.filter(SP_SOH_Uploads.Brand==brand)
-    # choose latest header first
-    q = q.order_by(SP_SOH_Uploads.SOHUploadID.desc()) 
-    row = q.first()
-    return float(row[0]) if row else 0.0
-
-def _post_ledger_adjust(customer_id:int, sku_id:int, d:date, new_qty:float, old_qty:float,
-                        hdr_id:int, row_num:int, movement_type:str):
+    rows = (model.query(SP_SOH_Uploads.Brand, SP_SOH_Detail.SKU_ID, SP_SOH_Detail.SOHQty)
+            .join(SP_SOH_Uploads, SP_SOH_Uploads.SOHUploadID==SP_SOH_Detail.SOHUploadID)
+            .filter(SP_SOH_Uploads.CustomerID==customer_id,
+                    SP_SOH_Detail.SOHDate==soh_date,
+                    SP_SOH_Detail.IsActive==True)
+            # ascending, so later headers overwrite earlier ones below
+            .order_by(SP_SOH_Uploads.SOHUploadID)
+            .all())
+    # brands are stored canonical UPPER, but key them the way the CI collation matches
+    return {((brand or "").upper(), sku_id): float(qty or 0) for brand, sku_id, qty in rows}
+
+def _ledger_adjust_row(customer_id:int, sku_id:int, d:date, new_qty:float, old_qty:float,
+                       hdr_id:int, row_num:int, movement_type:str, created_at:datetime) -> dict:
     """
-    Create a ledger snapshot delta row.
+    Build a ledger snapshot delta row (as a mapping for bulk_insert_mappings).
     movement_type:
       - "ADJUST"    for first-time / initial brand SOH
       - "SUPERCEED" for later corrections / re-uploads for the same brand
@@ -265,7 +375,7 @@ def _post_ledger_adjust(customer_id:int, sku_id:int, d:date, new_qty:float, old_
     diff = float(new_qty) - float(old_qty)
     # You *can* skip zero-diff if you want to reduce noise
     idem = f"SOH_{movement_type}:{hdr_id}:{row_num}"
-    model.add(SP_InventoryLedger(
+    return dict(
         CustomerID=customer_id,
         SKU_ID=sku_id,
         DocDate=d,
@@ -276,14 +386,19 @@ def _post_ledger_adjust(customer_id:int, sku_id:int, d:date, new_qty:float, old_
         RefTable="SP_SOH_Uploads",
         RefID=str(hdr_id),
         IdempotencyKey=idem,
-        CreatedAt=datetime.now(TZ_RIYADH)
-    ))
+        CreatedAt=created_at,
+    )
 
 
 def _get_form_date_from_request() -> date | None:
     raw = (request.form.get("sohDate") or "").strip()
     if not raw:
         return None
+    try:
+        # <input type="date"> always posts ISO YYYY-MM-DD: C parser, no pandas
+        return date.fromisoformat(raw)
+    except ValueError:
+        pass
     try:
         # parse with pandas, then cast to .date()
         return pd.to_datetime(raw, errors="raise").date()
@@ -334,50 +449,72 @@ def upload():
         # except Exception as _e:
         #     current_app.logger.exception("DEBUG HASH lookup failed")
         
-        dup = (model.query(SP_SOH_Uploads.SOHUploadID)
-               .filter(SP_SOH_Uploads.CustomerID==customer_id,
-                       SP_SOH_Uploads.SourceFileHash==file_hash)
-               .first())
+        # Checked before the sheet is parsed, and past the per-user RBAC criteria
+        # (plain connection, not ORM): UX_SOH_Customer_FileHash rejects the file
+        # whatever brand it was first uploaded under, so a brand-scoped user
+        # should hear about it here rather than after the full parse
+        dup = model.connection().execute(
+            select(SP_SOH_Uploads.SOHUploadID)
+            .where(SP_SOH_Uploads.CustomerID==customer_id,
+                   SP_SOH_Uploads.SourceFileHash==file_hash)
+            .limit(1)
+        ).first()
         if dup:
             return jsonify(ok=False, error="This exact file was already uploaded for this customer."), 400
 
-        df = _load_df(fs).copy()
-        df.columns = [c.strip() for c in df.columns]
+        df = _load_df(fs)   # fresh frame, headers already stripped + normalized
 
         required_cols = {"Brand","MEC_SKU","SOHQty"}
         missing = [c for c in required_cols if c not in df.columns]
         if missing:
             return jsonify(ok=False, error=f"Missing required columns: {', '.join(missing)}"), 400
         
-        # ---- Validate and normalize Brand names ----
+        if "RowNumber" not in df.columns:
+            df["RowNumber"] = range(1, len(df)+1)
+
+        # ---- Validate Brand + Article in one pass, report every bad row at once ----
         # Load master list of valid brand names from DB
-        valid_brands = { (b.BrandName or "").strip().upper() for b in model.query(Brands).all() if (b.BrandName or "").strip() }
-        valid_lower_map = { vb.lower(): vb for vb in valid_brands }  # lowercase -> canonical uppercase
+        valid_lower_map = _get_brand_lower_map()  # lowercase -> canonical uppercase
+
+        brand_raw     = df["Brand"].astype("string").str.strip()
+        brand_canon   = brand_raw.str.lower().map(valid_lower_map)
+        brand_missing = (brand_raw.isna() | (brand_raw == "")).to_numpy(dtype=bool)
+        brand_unknown = ~brand_missing & brand_canon.isna().to_numpy(dtype=bool)
+
+        # Articles exact-match in RTOS_MCSI since 2023; rows without a QTY are
+        # dropped further down, so they are not held against the file here
+        has_qty = pd.to_numeric(df["SOHQty"], errors="coerce").notna().to_numpy(dtype=bool)
+        article = df["MEC_SKU"].astype("string").str.strip()
+        article_missing = has_qty & (article.isna() | (article == "")).to_numpy(dtype=bool)
+        known = _existing_mcsi_articles(article[has_qty & ~article_missing].unique())
+        article_unknown = has_qty & ~article_missing & ~article.str.lower().isin(known).to_numpy(dtype=bool)
+
+        # only the offending rows are formatted, in sheet order
+        row_nums = df["RowNumber"].to_numpy()
         row_errors = []
-        
-        for _, r in df.iterrows():
-            rn = int(r.get("RowNumber") or 0)
-            brand = (str(r.get("Brand") or "").strip())
-            if not brand:
+        for i in np.flatnonzero(brand_missing | brand_unknown | article_missing | article_unknown):
+            rn = int(row_nums[i])
+            if brand_missing[i]:
                 row_errors.append(f"Row {rn}: Brand is required.")
-                continue
-        
-            brand_lower = brand.lower()
-            if brand_lower not in valid_lower_map:
+            elif brand_unknown[i]:
                 # spelling or unrecognized brand error
+                row_errors.append(f'Row {rn}: Invalid brand/Spelling  "{brand_raw.iat[i]}". ')
+            if article_missing[i]:
+                row_errors.append(f'Row {rn}: Article is required.')
+            elif article_unknown[i]:
                 row_errors.append(
-                    f'Row {rn}: Invalid brand/Spelling  "{brand}". '
-                    # f'Allowed brands are: {", ".join(sorted(valid_brands))}.'
+                    f'Article on excel row {rn} named "{article.iat[i]}" does not exist in MCSI since 2023 or there is a spelling mismatch'
                 )
-            else:
-                # fix to uppercase canonical
-                df.at[_, "Brand"] = valid_lower_map[brand_lower]
-        
+
         if row_errors:
             return jsonify(ok=False, error="; ".join(row_errors)), 400
+
+        # fix to uppercase canonical
+        df["Brand"] = brand_canon
+        df["MEC_SKU"] = article
         
         
-                # ---- Collect all brands present in this file ----
+        # ---- Collect all brands present in this file ----
         upload_brands = sorted({
             (str(b).strip())
             for b in df["Brand"].dropna().unique()
@@ -409,83 +546,68 @@ def upload():
                 ), 400
         
 
-        df["SOHQty"] = pd.to_numeric(df["SOHQty"], errors="coerce")
-        if "RowNumber" not in df.columns:
-            df["RowNumber"] = range(1, len(df)+1)
-        df = df.dropna(subset=["SOHQty"])
+        qty = pd.to_numeric(df["SOHQty"], errors="coerce").to_numpy(dtype="float64")
+        df["SOHQty"] = qty
+        keep = ~np.isnan(qty)
+        if not keep.all():
+            df, qty = df[keep], qty[keep]
         if df.empty:
             return jsonify(ok=False, error="No valid rows (SOHQty missing)"), 400
-        
-        # ----- Block negative SOHQty with row numbers -----
-        neg_rows = df.loc[pd.to_numeric(df["SOHQty"], errors="coerce") < 0, ["RowNumber", "MEC_SKU", "SOHQty"]]
-        if not neg_rows.empty:
-            msgs = [f'Row {int(r.RowNumber)}: SOHQty cannot be negative (value {r.SOHQty}). Article: {str(r.MEC_SKU).strip()}'
-                    for _, r in neg_rows.iterrows()]
-            return jsonify(ok=False, error="; ".join(msgs)), 400
-        
-        bad = df.loc[(df["SOHQty"] % 1) != 0, ["RowNumber","MEC_SKU","SOHQty"]]
-        if not bad.empty:
-            msgs = [f'Row {int(x.RowNumber)}: QTY must be a whole number (got {x.SOHQty}). Article: {x.MEC_SKU}'
-                    for _, x in bad.iterrows()]
-            return jsonify(ok=False, error="; ".join(msgs)), 400
 
-        # --- Validate Articles (exact match in RTOS_MCSI since 2023) ---
-        row_errors = []
-        for _, r in df.iterrows():
-            rn      = int(r.get("RowNumber") or 0)
-            brand   = (r.get("Brand") or "").strip()
-            article = str(r.get("MEC_SKU") or "").strip()
-
-            if not brand:
-                row_errors.append(f'Row {rn}: Brand is required.')
-                continue
-            if not article:
-                row_errors.append(f'Row {rn}: Article is required.')
-                continue
-            if not _article_exists_in_mCSI_exact(article):
-                row_errors.append(
-                    f'Article on excel row {rn} named "{article}" does not exist in MCSI since 2023 or there is a spelling mismatch'
-                )
+        # ----- Block negative / fractional SOHQty with row numbers -----
+        row_nums = df["RowNumber"].to_numpy()
+        mec_skus = df["MEC_SKU"].to_numpy()
 
-        if row_errors:
-            return jsonify(ok=False, error="; ".join(row_errors)), 400
+        neg_idx = np.flatnonzero(qty < 0)
+        if neg_idx.size:
+            msgs = [f'Row {int(row_nums[i])}: SOHQty cannot be negative (value {qty[i]}). Article: {str(mec_skus[i]).strip()}'
+                    for i in neg_idx]
+            return jsonify(ok=False, error="; ".join(msgs)), 400
+
+        frac_idx = np.flatnonzero(np.mod(qty, 1.0) != 0.0)
+        if frac_idx.size:
+            msgs = [f'Row {int(row_nums[i])}: QTY must be a whole number (got {qty[i]}). Article: {mec_skus[i]}'
+                    for i in frac_idx]
+            return jsonify(ok=False, error="; ".join(msgs)), 400
 
         # --- Resolve/Create SKUs & group detail records by Brand ---
-        # from collections import defaultdict
-        records_by_brand: dict[str, list[dict]] = defaultdict(list)
+        cust_col = next((c for c in ("CustSKUCode", "Cust-SKU") if c in df.columns), None)
+        cust_codes = (df[cust_col].astype("string").str.strip() if cust_col
+                      else pd.Series(pd.NA, index=df.index, dtype="string"))
 
         with _begin_tx(model):
-            # 1) Build records per brand
-            for _, r in df.iterrows():
-                rn        = int(r["RowNumber"])
-                brand     = (r.get("Brand") or "").strip()
-                article   = (r.get("MEC_SKU") or "").strip()
-                cust_code = str(r.get("CustSKUCode") or r.get("Cust-SKU") or "").strip() or None
-                qty       = float(r.get("SOHQty") or 0.0)
-
-                if not brand:
-                    row_errors.append(f"Row {rn}: Brand is required.")
-                    continue
-
-                sku_id = _get_or_create_sku(brand, article)
-                if not sku_id:
-                    row_errors.append(f"Row {rn}: Unable to create/resolve SKU for [{brand}] / [{article}].")
-                    continue
-
-                _ensure_customer_sku_map(customer_id, sku_id, cust_code)
-
-                records_by_brand[brand].append({
-                    "SKU_ID":    int(sku_id),
-                    "SOHQty":    qty,
-                    "RowNumber": rn,
-                })
-
-            if row_errors:
+            # 1) Resolve each distinct (Brand, Article) once, then map back onto the rows
+            sku_map = _resolve_skus(df[["Brand", "MEC_SKU"]].drop_duplicates().itertuples(index=False, name=None))
+            df["SKU_ID"] = df.set_index(["Brand", "MEC_SKU"]).index.map(sku_map).to_numpy()
+
+            unresolved = df["SKU_ID"].isna()
+            if unresolved.any():
+                row_errors = [f"Row {int(rn)}: Unable to create/resolve SKU for [{brand}] / [{art}]."
+                              for rn, brand, art in zip(df.loc[unresolved, "RowNumber"],
+                                                        df.loc[unresolved, "Brand"],
+                                                        df.loc[unresolved, "MEC_SKU"])]
                 model.rollback()
                 return jsonify(ok=False, error="; ".join(row_errors)), 400
 
+            # first code seen per SKU wins, as the row loop did
+            has_code = (cust_codes.notna() & (cust_codes != "")).to_numpy(dtype=bool)
+            for sku_id, code in (pd.DataFrame({"SKU_ID": df["SKU_ID"][has_code], "Code": cust_codes[has_code]})
+                                   .drop_duplicates("SKU_ID").itertuples(index=False, name=None)):
+                _ensure_customer_sku_map(customer_id, int(sku_id), code)
+
+            # per brand: parallel (sku_ids, qtys, row_nums) columns, no dict per row;
+            # .tolist() hands the driver plain Python ints/floats
+            records_by_brand: dict[str, tuple[list, list, list]] = {
+                brand: (sub["SKU_ID"].to_numpy(dtype=np.int64).tolist(),
+                        sub["SOHQty"].to_numpy(dtype=np.float64).tolist(),
+                        sub["RowNumber"].to_numpy(dtype=np.int64).tolist())
+                for brand, sub in df.groupby("Brand", sort=True)
+            }
+
             deactivated_total = 0
-            inserted_total    = 0
+            detail_rows: list[dict] = []
+            ledger_rows: list[dict] = []
+            now_riyadh = datetime.now(TZ_RIYADH)   # one timestamp for every header + ledger row
             superseded_ids_total: list[int] = []
             first_hdr_id = None
 
@@ -494,35 +616,43 @@ def upload():
             # - other (e.g. Supersede) => SUPERCEED
             movement_type = "ADJUST" if snapshot_type.lower() == "initial" else "SUPERCEED"
 
-            # 2) Process each brand chunk separately: one header per (customer, brand, date)
-            for brand in sorted(records_by_brand.keys()):
-                brand_records = records_by_brand[brand]
-                if not brand_records:
-                    continue
-
-                # 2a) Deactivate prior active details for this customer+brand+date
-                prior_hdr_q = (
-                    model.query(SP_SOH_Uploads)
+            # 2a) Prior headers for every brand in the file (one SELECT), and one
+            #     UPDATE deactivating all their active details for this date
+            prior_by_brand: dict[str, list] = defaultdict(list)
+            for h in (model.query(SP_SOH_Uploads)
+                      .filter(
+                          SP_SOH_Uploads.CustomerID == customer_id,
+                          SP_SOH_Uploads.Date == the_date,
+                          SP_SOH_Uploads.Brand.in_(sorted(records_by_brand)),
+                      )
+                      .order_by(SP_SOH_Uploads.SOHUploadID)
+                      .all()):
+                # brands are stored canonical UPPER, but match the way the CI collation did
+                prior_by_brand[(h.Brand or "").upper()].append(h)
+
+            prior_hdr_ids = [h.SOHUploadID for hs in prior_by_brand.values() for h in hs]
+            if prior_hdr_ids:
+                deactivated = (
+                    model.query(SP_SOH_Detail)
                     .filter(
-                        SP_SOH_Uploads.CustomerID == customer_id,
-                        SP_SOH_Uploads.Date == the_date,
-                        SP_SOH_Uploads.Brand == brand,
+                        SP_SOH_Detail.SOHUploadID.in_(prior_hdr_ids),
+                        SP_SOH_Detail.SOHDate == the_date,
+                        SP_SOH_Detail.IsActive == True,
                     )
+                    .update({SP_SOH_Detail.IsActive: False}, synchronize_session=False)
                 )
-                prior_headers = prior_hdr_q.all()
-                prior_hdr_ids = [h.SOHUploadID for h in prior_headers]
-
-                if prior_hdr_ids:
-                    deactivated = (
-                        model.query(SP_SOH_Detail)
-                        .filter(
-                            SP_SOH_Detail.SOHUploadID.in_(prior_hdr_ids),
-                            SP_SOH_Detail.SOHDate == the_date,
-                            SP_SOH_Detail.IsActive == True,
-                        )
-                        .update({SP_SOH_Detail.IsActive: False}, synchronize_session=False)
-                    )
-                    deactivated_total += int(deactivated)
+                deactivated_total += int(deactivated)
+
+            # Prior active qtys in one query, read after 2a like the per-row lookup
+            # it replaces, so the ledger deltas posted are unchanged
+            prior_qty = _get_prior_active_qtys(customer_id, the_date)
+
+            # 2) Process each brand chunk separately: one header per (customer, brand, date)
+            for brand in sorted(records_by_brand.keys()):
+                sku_ids, qtys, row_nums = records_by_brand[brand]
+                if not sku_ids:
+                    continue
+                prior_headers = prior_by_brand.get(brand, [])
 
                 # 2b) New header for this brand
                 hdr = SP_SOH_Uploads(
@@ -532,7 +662,7 @@ def upload():
                     Date           = the_date,
                     Status         = "Draft",
                     CreatedBy      = created_by,
-                    CreatedAt      = datetime.now(tz=ZoneInfo("Asia/Riyadh") if ZoneInfo else None),
+                    CreatedAt      = now_riyadh,
                     SourceFileName = fs.filename,
                     SourceFileHash = file_hash,
                 )
@@ -547,57 +677,52 @@ def upload():
                     ph.SupersededByUploadID = hdr.SOHUploadID
                     superseded_ids_total.append(ph.SOHUploadID)
 
-                # 2c) Details + ledger for this brand
-                detail_objs = []
-                for rec in brand_records:
-                    old_qty = _get_prior_active_qty_for_day(customer_id, brand, rec["SKU_ID"], the_date)
+                # 2c) Details + ledger for this brand, inserted in bulk after the loop
+                for sku_id, qty, row_num in zip(sku_ids, qtys, row_nums):
+                    old_qty = prior_qty.get((brand, sku_id), 0.0)
 
-                    detail_objs.append(SP_SOH_Detail(
+                    detail_rows.append(dict(
                         SOHUploadID = hdr.SOHUploadID,
-                        SKU_ID      = rec["SKU_ID"],
-                        RowNumber   = rec["RowNumber"],
+                        SKU_ID      = sku_id,
+                        RowNumber   = row_num,
                         SOHDate     = the_date,
-                        SOHQty      = rec["SOHQty"],
+                        SOHQty      = qty,
                         IsActive    = True,
                     ))
 
-                    _post_ledger_adjust(
+                    ledger_rows.append(_ledger_adjust_row(
                         customer_id = customer_id,
-                        sku_id      = rec["SKU_ID"],
+                        sku_id      = sku_id,
                         d           = the_date,
-                        new_qty     = rec["SOHQty"],
+                        new_qty     = qty,
                         old_qty     = old_qty,
                         hdr_id      = hdr.SOHUploadID,
-                        row_num     = rec["RowNumber"],
+                        row_num     = row_num,
                         movement_type = movement_type,
-                    )
-
-                model.add_all(detail_objs)
-                inserted_total += len(detail_objs)
+                        created_at  = now_riyadh,
+                    ))
 
-            # 3) Mark customer Active if it has at least one ADJUST row
-            has_adjust = (
-                model.query(SP_InventoryLedger.CustomerID)
-                .filter(
+            # executemany (fast_executemany on MSSQL) instead of per-object unit-of-work INSERTs
+            model.bulk_insert_mappings(SP_SOH_Detail, detail_rows)
+            model.bulk_insert_mappings(SP_InventoryLedger, ledger_rows)
+            inserted_total = len(detail_rows)
+
+            # 3) Mark customer Active if it has at least one ADJUST row (one UPDATE ... WHERE EXISTS)
+            active_id = _get_active_status_id()
+            model.query(SP_Customer).filter(
+                SP_Customer.CustomerID == customer_id,
+                (SP_Customer.StatusID != active_id) | (SP_Customer.StatusID.is_(None)),
+                exists().where(
                     SP_InventoryLedger.CustomerID == customer_id,
                     SP_InventoryLedger.MovementType == "ADJUST",
-                )
-                .first()
+                ),
+            ).update(
+                {
+                    SP_Customer.StatusID: active_id,
+                    SP_Customer.StatusDate: the_date,
+                },
+                synchronize_session=False,
             )
-            if has_adjust:
-                active_id = _get_active_status_id()
-                model.query(SP_Customer).filter(
-                    SP_Customer.CustomerID == customer_id,
-                    (SP_Customer.StatusID != active_id) | (SP_Customer.StatusID.is_(None)),
-                ).update(
-                    {
-                        SP_Customer.StatusID: active_id,
-                        SP_Customer.StatusDate: the_date,
-                    },
-                    synchronize_session=False,
-                )
-
-            
 
         model.commit()
         return jsonify(
@@ -1,14 +1,14 @@
 # blueprints/user_admin.py
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from datetime import datetime
-from functools import wraps
+from functools import lru_cache, wraps
 
 from flask import (
     Blueprint, render_template, request, redirect,
     url_for, flash, jsonify, abort, session
 )
 from flask_login import login_required, current_user
-from sqlalchemy import select, delete
+from sqlalchemy import event, select, delete, insert, literal, union_all
 from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash
 
@@ -19,11 +19,15 @@ from models import (
     Brands, SP_Customer, SP_CategoriesMappingMain
 )
 
-import re, secrets, string
+import re, secrets, string, time
 
 from config import STATIC_DIR, BASE_DIR, Config
 from utils.emailing import send_email
+from utils import background
 import html
+import logging
+
+log = logging.getLogger(__name__)
 
 bp = Blueprint("user_admin", __name__, static_folder=STATIC_DIR, url_prefix="/admin/users")
 
@@ -40,6 +44,54 @@ def require_role(*allowed):
         return wrapper
     return deco
 
+# ==========================================
+# Brand / customer / category lookups (TTL)
+# ==========================================
+LOOKUP_TTL = 300   # seconds; ORM writes to the three tables drop it sooner
+
+BrandRow    = namedtuple("BrandRow", "BrandID BrandName")
+CustomerRow = namedtuple("CustomerRow", "CustomerID CustCode CustName LevelType")
+CategoryRow = namedtuple("CategoryRow", "ID CatCode CatName CatDesc")
+
+_lookups = {"stamp": float("-inf"), "brands": (), "customers": (), "categories": ()}
+
+def _access_lookups():
+    """
+    Plain-tuple snapshots of Brands / SP_Customer / SP_CategoriesMappingMain for
+    the admin screens, re-read at most every LOOKUP_TTL seconds. Read past the
+    per-user RBAC criteria (plain connection), since one copy serves every admin.
+    """
+    global _lookups
+    if time.monotonic() - _lookups["stamp"] <= LOOKUP_TTL:
+        return _lookups
+    conn = model.connection()
+    fresh = {
+        "brands": tuple(BrandRow(*r) for r in conn.execute(
+            select(Brands.BrandID, Brands.BrandName).order_by(Brands.BrandName))),
+        "customers": tuple(CustomerRow(*r) for r in conn.execute(
+            select(SP_Customer.CustomerID, SP_Customer.CustCode, SP_Customer.CustName, SP_Customer.LevelType)
+            .order_by(SP_Customer.CustCode, SP_Customer.CustName))),
+        "categories": tuple(CategoryRow(*r) for r in conn.execute(
+            select(SP_CategoriesMappingMain.ID, SP_CategoriesMappingMain.CatCode,
+                   SP_CategoriesMappingMain.CatName, SP_CategoriesMappingMain.CatDesc)
+            .order_by(SP_CategoriesMappingMain.ID))),
+        "stamp": time.monotonic(),
+    }
+    _lookups = fresh   # swap the whole dict, readers never see a half-built one
+    return fresh
+
+@event.listens_for(Brands, "after_insert")
+@event.listens_for(Brands, "after_update")
+@event.listens_for(Brands, "after_delete")
+@event.listens_for(SP_Customer, "after_insert")
+@event.listens_for(SP_Customer, "after_update")
+@event.listens_for(SP_Customer, "after_delete")
+@event.listens_for(SP_CategoriesMappingMain, "after_insert")
+@event.listens_for(SP_CategoriesMappingMain, "after_update")
+@event.listens_for(SP_CategoriesMappingMain, "after_delete")
+def _invalidate_access_lookups(mapper, connection, target):
+    _lookups["stamp"] = float("-inf")
+
 # =========================
 # User Creation (GET/POST)
 # =========================
@@ -49,9 +101,10 @@ def require_role(*allowed):
 @require_role("admin", "developer")
 def users_create_form():
     """Render the Create User form with brand/category/customer lists."""
-    brands = model.execute(select(Brands).order_by(Brands.BrandName)).scalars().all()
-    categories = model.execute(select(SP_CategoriesMappingMain).order_by(SP_CategoriesMappingMain.ID)).scalars().all()
-    customers = model.execute(select(SP_Customer).order_by(SP_Customer.CustCode)).scalars().all()
+    lookups    = _access_lookups()
+    brands     = lookups["brands"]
+    categories = lookups["categories"]
+    customers  = lookups["customers"]
     
     creator_role = getattr(current_user, "role", None) or session.get("role") or ""
 
@@ -69,21 +122,80 @@ def _gen_password(length=12):
     alphabet = string.ascii_letters + string.digits + "!@#%^*-_=+?"
     return "".join(secrets.choice(alphabet) for _ in range(length))
 
+_SLUG_RE = re.compile(r"[^A-Za-z0-9._-]+")
+_DOTS_RE = re.compile(r"\.{2,}")
+_LIKE_ESC_RE = re.compile(r"([\\%_\[])")   # LIKE metacharacters, SQL Server flavour
+
 def _slug_username_from_email(email):
     local = (email.split("@", 1)[0] or "").strip()
-    local = re.sub(r"[^A-Za-z0-9._-]+", ".", local)
-    local = re.sub(r"\.{2,}", ".", local).strip("._-")
+    local = _DOTS_RE.sub(".", _SLUG_RE.sub(".", local)).strip("._-")
     return (local or "user")[:30]
 
 def _ensure_unique_username(base):
+    # One query for every username that could collide, then probe locally.
+    # Candidates may trim base to fit the suffix, so match on a prefix short
+    # enough to cover them; compare case-insensitively like the DB collation.
+    prefix = base[:20]
+    pattern = _LIKE_ESC_RE.sub(r"\\\1", prefix) + "%"
+    taken = {
+        (n or "").casefold()
+        for n in model.execute(
+            select(SP_Users.Username).where(SP_Users.Username.like(pattern, escape="\\"))
+        ).scalars()
+    }
     candidate = base
     i = 2
-    while model.execute(select(SP_Users.UserID).where(SP_Users.Username == candidate)).first():
+    while candidate.casefold() in taken:
         suffix = f"-{i}"
         candidate = base[: (30 - len(suffix))] + suffix
         i += 1
     return candidate
 
+def _insert_access_rows(user_id, brand_ids, cust_ids, cat_ids):
+    """One executemany INSERT per mapping table (no ORM unit-of-work for join rows)."""
+    if brand_ids:
+        model.execute(insert(SP_UserBrand),
+                      [{"UserID": user_id, "BrandID": bid} for bid in brand_ids])
+    if cust_ids:
+        model.execute(insert(SP_UserCustomer),
+                      [{"UserID": user_id, "CustomerID": cid} for cid in cust_ids])
+    if cat_ids:
+        model.execute(insert(SP_UserCategory),
+                      [{"UserID": user_id, "CategoryID": cid} for cid in cat_ids])
+
+def _sync_access(table, col, user_id, wanted):
+    """
+    Make `table` hold exactly `wanted` ids for user_id: INSERT the new ones,
+    DELETE the dropped ones, leave the rest alone.
+    """
+    # plain connection: the link rows themselves, not the per-user RBAC view of them
+    existing = set(model.connection().execute(
+        select(col).where(table.UserID == user_id)
+    ).scalars())
+    to_del = existing - wanted
+    to_add = wanted - existing
+    if to_del:
+        model.execute(delete(table).where(table.UserID == user_id, col.in_(to_del)))
+    if to_add:
+        model.execute(insert(table), [{"UserID": user_id, col.key: x} for x in to_add])
+
+@lru_cache(maxsize=1)
+def _smtp_settings() -> dict:
+    # SMTP config (no hardcoding; use env or Flask config), parsed once per process
+    return dict(
+        smtp_server=Config.SMTP_SERVER,
+        smtp_port=int(Config.SMTP_PORT or 587),
+        smtp_username=Config.SMTP_USERNAME,
+        smtp_password=Config.SMTP_PASSWORD,
+    )
+
+def _send_credentials_email(username, subject, sender, recipients, html_content, smtp):
+    # runs on the background pool: no request to flash into, so failures go to the log
+    try:
+        send_email(subject, sender, recipients, html_content, **smtp)
+    except Exception:
+        log.exception("Sending credentials email for user %r failed", username)
+
 def _fetch_access_names(brand_ids, cust_ids, cat_ids):
     brands = []
     customers = []
@@ -134,10 +246,9 @@ def users_create_submit():
         flash("Email and Role are required.", "danger")
         return redirect(url_for("user_admin.users_create_form"))
 
-    # Username fallback and uniqueness
+    # Username fallback (uniqueness is settled inside the write transaction)
     if not username:
         username = _slug_username_from_email(email)
-    username = _ensure_unique_username(username)
 
     # Access scopes
     try:
@@ -179,60 +290,64 @@ def users_create_submit():
             flash("Please select at least one access scope: Brand, Category, or Customer.", "danger")
             return redirect(url_for("user_admin.users_create_form"))
 
-    # Optional: validate FK existence for nicer feedback
-    def _missing_ids(col, ids):
-        if not ids:
-            return set()
-        existing = {r[0] for r in model.execute(select(col).where(col.in_(ids))).all()}
-        return ids - existing
-
-    miss = {}
-    m = _missing_ids(Brands.BrandID, brand_ids)
-    if m: miss["brands"] = sorted(m)
-    m = _missing_ids(SP_Customer.CustomerID, cust_ids)
-    if m: miss["customers"] = sorted(m)
-    m = _missing_ids(SP_CategoriesMappingMain.ID, cat_ids)
-    if m: miss["categories"] = sorted(m)
-    if miss:
-        flash(f"Some access IDs do not exist: {miss}", "danger")
-        return redirect(url_for("user_admin.users_create_form"))
+    # Hash before the transaction opens so the slow KDF doesn't hold it
+    pwd_hash = generate_password_hash(pwd)
 
-    # Persist
+    wanted = {"brands": brand_ids, "customers": cust_ids, "categories": cat_ids}
+    probes = [
+        select(literal(k).label("k"), col.label("id")).where(col.in_(wanted[k]))
+        for k, col in (("brands", Brands.BrandID),
+                       ("customers", SP_Customer.CustomerID),
+                       ("categories", SP_CategoriesMappingMain.ID))
+        if wanted[k]
+    ]
+
+    # Persist: validation reads and writes share one transaction, committed once
     try:
-        # make sure we’re not in a leftover transaction from the read phase
+        # the auth lookup may have autobegun a read transaction; end it so the
+        # block below owns the whole unit of work
         if model.in_transaction():
             model.rollback()
-    
-        u = SP_Users(
-            Username=username,
-            Password=generate_password_hash(pwd),
-            Role=role,
-            Email=email,
-            Fullname=fullname,
-            IsActive=bool(is_active),
-            Company=company,
-            Department=department,
-            CreatedAt=func.now(),
-        )
-        model.add(u)
-        model.flush()  # to get u.UserID
-    
-        if brand_ids:
-            model.add_all([SP_UserBrand(UserID=u.UserID, BrandID=bid) for bid in brand_ids])
-        if cat_ids:
-            model.add_all([SP_UserCategory(UserID=u.UserID, CategoryID=cid) for cid in cat_ids])
-        if cust_ids:
-            model.add_all([SP_UserCustomer(UserID=u.UserID, CustomerID=ccid) for ccid in cust_ids])
-    
-        model.commit()
+
+        with model.begin():
+            username = _ensure_unique_username(username)
+
+            # Optional: validate FK existence for nicer feedback (one UNION ALL round-trip)
+            found = defaultdict(set)
+            if probes:
+                for k, id_ in model.connection().execute(union_all(*probes)).all():
+                    found[k].add(id_)
+            miss = {k: sorted(ids - found[k]) for k, ids in wanted.items() if ids - found[k]}
+            if miss:
+                flash(f"Some access IDs do not exist: {miss}", "danger")
+                return redirect(url_for("user_admin.users_create_form"))
+
+            # INSERT ... OUTPUT INSERTED.UserID: the new id comes back with the insert itself
+            user_id = model.execute(
+                insert(SP_Users).values(
+                    Username=username,
+                    Password=pwd_hash,
+                    Role=role,
+                    Email=email,
+                    Fullname=fullname,
+                    IsActive=bool(is_active),
+                    Company=company,
+                    Department=department,
+                    CreatedAt=func.now(),
+                ).returning(SP_Users.UserID)
+            ).scalar_one()
+
+            _insert_access_rows(user_id, brand_ids, cust_ids, cat_ids)
+
+            # names for the credentials email, read before the commit rather than
+            # autobeginning a second transaction afterwards
+            if f.get("send_credentials"):
+                provided_brands, provided_customers, provided_categories = _fetch_access_names(
+                    brand_ids, cust_ids, cat_ids
+                )
 
         # Optionally email credentials
         if f.get("send_credentials"):
-            # Build access lists for the email body (names, not just IDs)
-            provided_brands, provided_customers, provided_categories = _fetch_access_names(
-                brand_ids, cust_ids, cat_ids
-            )
-
             login_url =Config.SALES_PULSE_LOGIN_URL
             subject   = "Sales Pulse — Your Account Credentials"
             sender    = Config.SMTP_SENDER
@@ -244,7 +359,7 @@ def users_create_submit():
             esc_pass = html.escape(pwd)
             esc_role = html.escape(role)
 
-            html_content = f"""
+            parts = [f"""
             <div style="font-family:Arial,Helvetica,sans-serif; font-size:14px; color:#222">
               <p>Hello {esc_user},</p>
               <p>Your new account has been created in <strong>Sales Pulse</strong>:</p>
@@ -254,53 +369,50 @@ def users_create_submit():
                 <li><strong>Role:</strong> {esc_role}</li>
               </ul>
               <p>Login: <a href="{login_url}" target="_blank">{login_url}</a></p>
-            """
+            """]
 
+            # collect the pieces and join once (no quadratic str +=)
             if provided_brands:
-                html_content += "<p><strong>Brand Access:</strong></p><ul>"
-                for bid, bname in provided_brands:
-                    html_content += f"<li>{html.escape(str(bname))}</li>"
-                html_content += "</ul>"
+                parts.append("<p><strong>Brand Access:</strong></p><ul>")
+                parts.extend(f"<li>{html.escape(str(bname))}</li>" for bid, bname in provided_brands)
+                parts.append("</ul>")
 
             if provided_customers:
-                html_content += "<p><strong>Customer Access:</strong></p><ul>"
-                for cid, code, name in provided_customers:
-                    html_content += f"<li>{html.escape(code)} — {html.escape(name)}</li>"
-                html_content += "</ul>"
+                parts.append("<p><strong>Customer Access:</strong></p><ul>")
+                parts.extend(f"<li>{html.escape(code)} — {html.escape(name)}</li>"
+                             for cid, code, name in provided_customers)
+                parts.append("</ul>")
 
             if provided_categories:
-                html_content += "<p><strong>Category Access:</strong></p><ul>"
-                for cid, ccode, cname, cdesc in provided_categories:
-                    label = " — ".join([x for x in [ccode, cname, cdesc] if x])
-                    html_content += f"<li>{html.escape(label)}</li>"
-                html_content += "</ul>"
+                parts.append("<p><strong>Category Access:</strong></p><ul>")
+                parts.extend(f"<li>{html.escape(' — '.join([x for x in [ccode, cname, cdesc] if x]))}</li>"
+                             for cid, ccode, cname, cdesc in provided_categories)
+                parts.append("</ul>")
 
-            html_content += """
+            parts.append("""
               <p>If you have any questions or issues, reply to this email.</p>
               <p>Best regards,<br>Modern Electronics — Sales Pulse Team</p>
             </div>
-            """
-
-            # SMTP config (no hardcoding; use env or Flask config)
-            smtp_server = Config.SMTP_SERVER
-            smtp_port   = int(Config.SMTP_PORT or 587)
-            smtp_user   = Config.SMTP_USERNAME
-            smtp_pass   = Config.SMTP_PASSWORD
-
-            try:
-                send_email(subject, smtp_user, recipients, html_content,
-                           smtp_server=smtp_server, smtp_port=smtp_port,
-                           smtp_username=smtp_user, smtp_password=smtp_pass)
-                if creator_role == "developer" and auto_generated:
+            """)
+            html_content = "".join(parts)
+
+            smtp = _smtp_settings()
+            smtp_user = smtp["smtp_username"]
+
+            if creator_role == "developer" and auto_generated:
+                # Nobody else knows an auto-generated password, so this send stays
+                # inline: if it fails, the password is shown once below instead
+                try:
+                    send_email(subject, smtp_user, recipients, html_content, **smtp)
                     flash(f"User '{username}' created. Credentials emailed (auto-generated password).", "success")
-                else:
-                    flash(f"User '{username}' created and credentials emailed.", "success")
-            except Exception as mail_err:
-                # Don’t fail creation if email fails
-                if creator_role == "developer" and auto_generated:
+                except Exception:
+                    # Don’t fail creation if email fails
                     flash(f"User '{username}' created. Email failed; share this password securely: {pwd}", "warning")
-                else:
-                    flash(f"User '{username}' created, but sending email failed- ERROR: {mail_err}", "warning")
+            else:
+                # The SMTP handshake (TLS + login) is off the request path
+                background.submit(_send_credentials_email, username, subject, smtp_user,
+                                  recipients, html_content, smtp)
+                flash(f"User '{username}' created. Credentials will be emailed shortly.", "success")
         else:
             # No email requested
             if creator_role == "developer" and auto_generated:
@@ -333,13 +445,10 @@ def users_access_page():
       - Also pass full lookups so the template can render JS arrays via Jinja, if desired.
     """
     # Lookups
-    brands = model.execute(select(Brands).order_by(Brands.BrandName)).scalars().all()
-    customers = model.execute(
-        select(SP_Customer).order_by(SP_Customer.CustCode, SP_Customer.CustName)
-    ).scalars().all()
-    categories = model.execute(
-        select(SP_CategoriesMappingMain).order_by(SP_CategoriesMappingMain.ID)
-    ).scalars().all()
+    lookups    = _access_lookups()
+    brands     = lookups["brands"]
+    customers  = lookups["customers"]
+    categories = lookups["categories"]
     
     
     brands_json = [{"id": b.BrandID, "BrandName": b.BrandName} for b in brands]
@@ -350,27 +459,29 @@ def users_access_page():
     categories_json = [
         {
             "id": k.ID,
-            "CatName": getattr(k, "CatName", None) or "",
-            "CatDesc": getattr(k, "CatDesc", None) or "",
+            "CatName": k.CatName or "",
+            "CatDesc": k.CatDesc or "",
         }
         for k in categories
     ]
 
-    # Prefetch all mappings once, group by user
-    all_brand_map = defaultdict(list)
-    all_cust_map = defaultdict(list)
-    all_cat_map = defaultdict(list)
-
-    for row in model.execute(select(SP_UserBrand.UserID, SP_UserBrand.BrandID)).all():
-        all_brand_map[row[0]].append(row[1])
-    for row in model.execute(select(SP_UserCustomer.UserID, SP_UserCustomer.CustomerID)).all():
-        all_cust_map[row[0]].append(row[1])
-    for row in model.execute(select(SP_UserCategory.UserID, SP_UserCategory.CategoryID)).all():
-        all_cat_map[row[0]].append(row[1])
+    # Prefetch all mappings in one tagged UNION ALL round-trip, group by user
+    maps = {"b": defaultdict(list), "c": defaultdict(list), "k": defaultdict(list)}
+    links = union_all(
+        select(literal("b").label("k"), SP_UserBrand.UserID, SP_UserBrand.BrandID.label("id")),
+        select(literal("c"), SP_UserCustomer.UserID, SP_UserCustomer.CustomerID),
+        select(literal("k"), SP_UserCategory.UserID, SP_UserCategory.CategoryID),
+    )
+    for tag, uid, id_ in model.connection().execute(links):
+        maps[tag][uid].append(id_)
+    all_brand_map, all_cust_map, all_cat_map = maps["b"], maps["c"], maps["k"]
 
     # Build a light dict for each user so template can do:
     #   {{ u.brand_ids|join(',') }} etc
-    user_rows = model.execute(select(SP_Users).order_by(SP_Users.Username)).scalars().all()
+    user_rows = model.execute(
+        select(SP_Users.UserID, SP_Users.Username, SP_Users.Email, SP_Users.Role)
+        .order_by(SP_Users.Username)
+    ).all()
     users = []
     for u in user_rows:
         users.append({
@@ -419,22 +530,18 @@ def users_access_save():
         return jsonify({"ok": False, "msg": "User not found"}), 404
 
     # Extract assigned sets (ignore "available")
-    brand_ids = set(payload.get("brands", {}).get("assigned", []))
-    cust_ids  = set(payload.get("customers", {}).get("assigned", []))
-    cat_ids   = set(payload.get("categories", {}).get("assigned", []))
+    try:
+        brand_ids = {int(x) for x in payload.get("brands", {}).get("assigned", [])}
+        cust_ids  = {int(x) for x in payload.get("customers", {}).get("assigned", [])}
+        cat_ids   = {int(x) for x in payload.get("categories", {}).get("assigned", [])}
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "msg": "Access lists contain invalid IDs."}), 400
 
     try:
-        # Replace strategy: delete old → insert new (fast & predictable)
-        model.execute(delete(SP_UserBrand).where(SP_UserBrand.UserID == u.UserID))
-        model.execute(delete(SP_UserCustomer).where(SP_UserCustomer.UserID == u.UserID))
-        model.execute(delete(SP_UserCategory).where(SP_UserCategory.UserID == u.UserID))
-
-        if brand_ids:
-            model.add_all([SP_UserBrand(UserID=u.UserID, BrandID=bid) for bid in brand_ids])
-        if cust_ids:
-            model.add_all([SP_UserCustomer(UserID=u.UserID, CustomerID=cid) for cid in cust_ids])
-        if cat_ids:
-            model.add_all([SP_UserCategory(UserID=u.UserID, CategoryID=cid) for cid in cat_ids])
+        # Diff strategy: only touch the links that actually changed
+        _sync_access(SP_UserBrand, SP_UserBrand.BrandID, u.UserID, brand_ids)
+        _sync_access(SP_UserCustomer, SP_UserCustomer.CustomerID, u.UserID, cust_ids)
+        _sync_access(SP_UserCategory, SP_UserCategory.CategoryID, u.UserID, cat_ids)
 
         model.commit()
         return jsonify({"ok": True, "msg": "Access updated."})
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 # from models             import *
 # from app               import app
@@ -79,53 +80,72 @@ def load_c2h_to_sp_customer(session, xlsx_path: str, sheet_name: str = "Sheet1")
     for c in ["CustCode", "CustName", "HOCode", "HOName"]:
         df[c] = df[c].astype(str).str.strip()
 
-    # Unique list of customers (as-is)
-    custs = df[["CustCode", "CustName"]].drop_duplicates(subset=["CustCode"]).reset_index(drop=True)
+    # Which codes are HOs? (any code that appears in HOCode, on any row)
+    ho_codes = set(df["HOCode"].to_numpy().tolist())
 
-    # Which codes are HOs? (any code that appears in HOCode)
-    ho_codes = set(df["HOCode"].unique())
+    # Unique list of customers (as-is); first occurrence wins, which also gives
+    # the simple cust -> HOCode mapping without a separate set_index/to_dict pass
+    df.drop_duplicates(subset=["CustCode"], keep="first", inplace=True)
+    custs = df.drop(columns=["HOName"]).reset_index(drop=True)
 
-    # Build a simple cust -> HOCode mapping (first occurrence wins)
-    # If a customer has itself as HO (CustCode == HOCode), we'll treat parent as NULL.
-    cust_to_hocode = (
-        df.drop_duplicates(subset=["CustCode"])[["CustCode", "HOCode"]]
-        .set_index("CustCode")["HOCode"]
-        .to_dict()
-    )
+    # Stage rows: LevelType based on whether code is an HO somewhere; HOCode NULL
+    # when a customer is its own HO (or has none), so it gets no parent
+    custs["CustName"]  = custs["CustName"].fillna("").str.slice(0, 100)
+    custs["LevelType"] = np.where(custs["CustCode"].isin(ho_codes), "HO", "Branch")   # required non-null in your model
+    custs["HOCode"]    = custs["HOCode"].where((custs["HOCode"] != "") & (custs["HOCode"] != custs["CustCode"]), None)
+    rows = custs.astype(object).where(custs.notna(), None).to_dict("records")   # NaN -> NULL for the driver
 
     try:
-        session.query(SP_Customer).delete() 
-        session.flush()
-
-        # 3) Insert all customers "as is" (set LevelType based on whether code is an HO somewhere)
-        objs = []
-        for _, r in custs.iterrows():
-            code = r["CustCode"]
-            name = (r["CustName"] or "")[:100]
-            level = "HO" if code in ho_codes else "Branch"
-            objs.append(SP_Customer(
-                CustCode=code,
-                CustName=name,
-                LevelType=level,     # required non-null in your model
-                ParentCustID=None    # set in next step
-            ))
-        session.add_all(objs)
-        session.flush()  # assign CustomerID
-
-        # Map code -> id for quick parent lookup
-        code_to_id = {c.CustCode: c.CustomerID for c in session.query(SP_Customer).all()}
-
-        # 4) Set ParentCustID from HOCode (NULL if HOCode missing or equals self)
-        for c in session.query(SP_Customer).all():
-            hocode = cust_to_hocode.get(c.CustCode)
-            if hocode and hocode != c.CustCode:
-                parent_id = code_to_id.get(hocode)
-                c.ParentCustID = parent_id if parent_id else None
-            else:
-                c.ParentCustID = None  # self-HO or no mapping → no parent
+        # 3) Upsert into SP_Customer by CustCode instead of delete-all + re-insert:
+        #    CustomerIDs stay stable for everything that references them, unchanged
+        #    rows are not rewritten, and codes missing from the file are removed
+        session.execute(text("""
+            CREATE TABLE #cust_stage (
+                -- temp tables take tempdb's collation; match the database's for the joins
+                CustCode  NVARCHAR(50)  COLLATE DATABASE_DEFAULT NOT NULL PRIMARY KEY,
+                CustName  NVARCHAR(255) COLLATE DATABASE_DEFAULT NOT NULL,
+                LevelType VARCHAR(10)   COLLATE DATABASE_DEFAULT NOT NULL,
+                HOCode    NVARCHAR(50)  COLLATE DATABASE_DEFAULT NULL
+            )
+        """))
+        if rows:
+            # one executemany: fast_executemany sends it as a single parameter array
+            session.execute(text(
+                "INSERT INTO #cust_stage (CustCode, CustName, LevelType, HOCode) "
+                "VALUES (:CustCode, :CustName, :LevelType, :HOCode)"
+            ), rows)
+
+        session.execute(text("""
+            MERGE SP_Customer AS t
+            USING #cust_stage AS s ON t.CustCode = s.CustCode
+            WHEN MATCHED AND (t.CustName <> s.CustName OR t.LevelType <> s.LevelType) THEN
+                UPDATE SET CustName = s.CustName, LevelType = s.LevelType
+            WHEN NOT MATCHED BY TARGET THEN
+                INSERT (CustCode, CustName, LevelType) VALUES (s.CustCode, s.CustName, s.LevelType);
+        """))
+
+        # 4) Set ParentCustID from HOCode in one set-based UPDATE (NULL for self-HO /
+        #    unmapped / unknown-HO customers), touching only rows whose parent changed.
+        #    Parents must be in the file too: a row about to be removed can't stay one
+        session.execute(text("""
+            UPDATE c SET ParentCustID = p.CustomerID
+            FROM SP_Customer c
+            JOIN #cust_stage s      ON s.CustCode = c.CustCode
+            LEFT JOIN #cust_stage ps ON ps.CustCode = s.HOCode
+            LEFT JOIN SP_Customer p ON p.CustCode = ps.CustCode
+            WHERE ISNULL(c.ParentCustID, -1) <> ISNULL(p.CustomerID, -1)
+        """))
+
+        # 5) Only now remove codes missing from the file: no kept row points at them,
+        #    so the ParentCustID self-FK holds (removed parent/child pairs go together)
+        session.execute(text("""
+            DELETE c FROM SP_Customer c
+            WHERE NOT EXISTS (SELECT 1 FROM #cust_stage s WHERE s.CustCode = c.CustCode)
+        """))
+        session.execute(text("DROP TABLE #cust_stage"))
 
         session.commit()
-        print(f"Inserted customers: {len(objs)}. Parent IDs populated from HOCode.")
+        print(f"Loaded customers: {len(rows)}. Parent IDs populated from HOCode.")
     except Exception:
         session.rollback()
         raise
@@ -1,7 +1,10 @@
 from sqlalchemy import *
 # from sqlalchemy import coalesce
+import json
 import urllib.parse
 from datetime import datetime
+from functools import lru_cache
+from itertools import islice
 from sqlalchemy.orm import (
         foreign, joinedload,  Mapped, mapped_column, 
         sessionmaker, scoped_session, with_loader_criteria, 
@@ -9,8 +12,9 @@ from sqlalchemy.orm import (
     )
 # from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy import event, literal_column
+from sqlalchemy.sql import visitors
 from config import Config
-from flask import session
+from flask import g, session
 from sqlalchemy.dialects import mssql
 
 import pyodbc
@@ -50,7 +54,12 @@ import pyodbc
 
 import os
 
-def db_connection():
+def db_connection(bulk=False):
+    """
+    bulk=True builds the small pool for ingestion jobs (sell-in API loads):
+    big TDS packets, no pre-ping, so a long load never holds one of the
+    connections UI requests queue for.
+    """
     # e.g. "mssql" or "sqlite"
     # set DB_BACKEND=sqlite
     backend = getattr(Config, "DB_BACKEND", None) or os.getenv("DB_BACKEND", "mssql")
@@ -74,29 +83,224 @@ def db_connection():
         f"DATABASE={DATABASE};"
         f"UID={USERNAME};"
         f"PWD={PSSWD};"
-        f"MARS_Connection=Yes"
+        f"MARS_Connection=Yes;"
+        f"APP=SalesPulse"        # shows as program_name in sys.dm_exec_sessions / Profiler
     )
+    if bulk:
+        # 32 KB TDS packets only on the 6-connection ingestion pool: with MARS
+        # each pooled UI connection would pin that buffer server-side, x40
+        odbc_str += ";Packet Size=32767"
 
     connect_arg = urllib.parse.quote_plus(odbc_str)
 
+    if bulk:
+        pool = dict(pool_size=4, max_overflow=2, pool_pre_ping=False)
+    else:
+        pool = dict(pool_size=30, max_overflow=10, pool_pre_ping=True)
+
     engine = create_engine(
         f"mssql+pyodbc:///?odbc_connect={connect_arg}",
-        pool_size=30,
-        max_overflow=10,
         pool_timeout=30,
-        pool_pre_ping=True,
+        pool_use_lifo=True,   # reuse the warmest connection; idle extras age out via recycle
         fast_executemany=True,
-        pool_recycle=3600
+        pool_recycle=3600,
+        connect_args={"timeout": 15},   # ODBC login timeout; fail fast when the server is unreachable
+        **pool
     )
     return engine
 
 
 engine = db_connection()
+bulk_engine = db_connection(bulk=True)
+
+
+def _decimal_as_float(raw):
+    # pyodbc hands DECIMAL/NUMERIC over as ASCII text ("12.500"); float() takes bytes
+    return None if raw is None else float(raw)
+
+def _register_float_decimals(eng):
+    """
+    Read DECIMAL/NUMERIC as float instead of decimal.Decimal. Every Numeric
+    column here is a Numeric(18, 3) quantity (ledger Qty, neg-preview
+    balances) that the code sums and float()s anyway, and building a Decimal
+    per cell dominated the preview/report loops. A double holds 18,3 values
+    exactly up to ~1e12; if an exact-money column is ever added, read it
+    with CAST(... AS VARCHAR) or drop this converter for that connection.
+    """
+    if eng.dialect.name != "mssql":
+        return
+
+    @event.listens_for(eng, "connect")
+    def _conv(dbapi_conn, _):
+        dbapi_conn.add_output_converter(pyodbc.SQL_DECIMAL, _decimal_as_float)
+        dbapi_conn.add_output_converter(pyodbc.SQL_NUMERIC, _decimal_as_float)
+
+_register_float_decimals(engine)
+_register_float_decimals(bulk_engine)
+
+class _ScopedSession(scoped_session):
+    # scoped_session doesn't proxy in_transaction(); the _begin_tx helpers use it
+    def in_transaction(self):
+        return self.registry().in_transaction()
 
 # initialize extensions
+# Session / BulkSession: plain sessions for background jobs and scripts (no RBAC).
+# model: one Session per request thread, with the RBAC hook below; app.py
+# removes it at the end of every request.
 Session = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
-model = Session()
+BulkSession = sessionmaker(bind=bulk_engine, autoflush=False, expire_on_commit=False)
+RequestSession = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+model = _ScopedSession(RequestSession)
 Base = declarative_base()
+
+@lru_cache(maxsize=1)
+def _rbac_classes(_n_mappers):
+    """
+    Mapped classes per RBAC column: (Brand, CustomerID, CategoryMappingID, SKU_ID).
+    Keyed on the mapper count so classes registered later are picked up.
+    """
+    classes = [m.class_ for m in Base.registry.mappers]
+    return tuple(
+        tuple(cls for cls in classes if hasattr(cls, attr))
+        for attr in ("Brand", "CustomerID", "CategoryMappingID", "SKU_ID")
+    )
+
+RBAC_INLIST_MAX = 50   # larger access sets go over as one JSON parameter
+
+# OPENJSON (SQL Server 2016+) / json_each (sqlite) turn one JSON string into a
+# row set, so a large IN() keeps one parameter, one SQL text and one plan
+_JSON_IDS = engine.dialect.name in ("mssql", "sqlite")
+
+def _json_ids(ids, sql_type):
+    """SELECT over the ids sent as a single JSON array parameter."""
+    payload = literal(json.dumps(list(ids)))
+    if engine.dialect.name == "mssql":
+        # typed like the column, so the comparison stays sargable
+        return select(literal_column(f"CAST([value] AS {sql_type})")).select_from(func.openjson(payload))
+    return select(literal_column("value")).select_from(func.json_each(payload))
+
+def _use_json(ids):
+    return _JSON_IDS and len(ids) > RBAC_INLIST_MAX
+
+# Criteria factories: each lambda is defined at one fixed spot and closes over
+# the factory's parameter, so SQLAlchemy caches the compiled criteria by code
+# location and passes the allowed IDs as bound parameters on every call.
+# Large sets use a plain expression over _json_ids() instead.
+def _brand_crit(cls, brands):
+    if _use_json(brands):
+        return with_loader_criteria(cls, cls.Brand.in_(_json_ids(brands, "VARCHAR(100)")), include_aliases=True)
+    return with_loader_criteria(cls, lambda c: c.Brand.in_(brands), include_aliases=True)
+
+def _cust_crit(cls, cust_ids):
+    if _use_json(cust_ids):
+        return with_loader_criteria(cls, cls.CustomerID.in_(_json_ids(cust_ids, "INT")), include_aliases=True)
+    return with_loader_criteria(cls, lambda c: c.CustomerID.in_(cust_ids), include_aliases=True)
+
+def _cat_crit(cls, cats):
+    if _use_json(cats):
+        return with_loader_criteria(cls, cls.CategoryMappingID.in_(_json_ids(cats, "INT")), include_aliases=True)
+    return with_loader_criteria(cls, lambda c: c.CategoryMappingID.in_(cats), include_aliases=True)
+
+def _sku_crit(cls, sku_ids):
+    if _use_json(sku_ids):
+        return with_loader_criteria(cls, cls.SKU_ID.in_(_json_ids(sku_ids, "INT")), include_aliases=True)
+    return with_loader_criteria(cls, lambda c: c.SKU_ID.in_(sku_ids), include_aliases=True)
+
+def _sku_cat_crit(cls, cats):
+    # EXISTS(select SP_SKU where SP_SKU.SKU_ID = cls.SKU_ID AND Category in allowed)
+    return with_loader_criteria(
+        cls,
+        lambda c: exists(
+            select(SP_SKU.SKU_ID).where(
+                and_(SP_SKU.SKU_ID == c.SKU_ID,
+                     SP_SKU.CategoryMappingID.in_(cats))
+            )
+        ),
+        include_aliases=True
+    )
+
+ALLOWED_SKUS_CAP = 2000   # SQL Server takes at most 2100 parameters per statement
+
+def _allowed_sku_ids(cats):
+    """
+    SKU_IDs in the allowed categories; None when there are too many to send
+    as an IN-list and the backend can't take them as JSON.
+    """
+    # Core on the session's connection: no do_orm_execute re-entry
+    ids = frozenset(model.connection().execute(
+        select(SP_SKU.SKU_ID).where(SP_SKU.CategoryMappingID.in_(cats))
+    ).scalars())
+    return ids if _JSON_IDS or len(ids) <= ALLOWED_SKUS_CAP else None
+
+def _rbac_scope():
+    """
+    Per-request memo on flask.g: the caller's access sets as frozensets, the
+    allowed SKU IN-list and every criteria option built so far. Rebuilt only
+    if the session's access lists change mid-request (e.g. at login).
+    """
+    raw = (session.get("user_brand_access"),
+           session.get("user_category_access_ids"),
+           session.get("user_customer_access_ids"))
+    scope = g.get("_rbac_scope")
+    if scope is None or scope["raw"] != raw:
+        brands, cats, cust_ids = (frozenset(x or ()) for x in raw)
+        scope = g._rbac_scope = {
+            "raw": tuple(None if x is None else list(x) for x in raw),
+            "brands": brands, "cats": cats, "cust_ids": cust_ids,
+            "crit": {},
+        }
+    return scope
+
+def _scoped_crits(scope, factory, classes, ids):
+    crit = scope["crit"]
+    out = []
+    for cls in classes:
+        opt = crit.get((factory, cls))
+        if opt is None:
+            opt = crit[(factory, cls)] = factory(cls, ids)
+        out.append(opt)
+    return out
+
+@lru_cache(maxsize=1)
+def _reachable_tables(_n_mappers):
+    """
+    Table name -> names of every table reachable from its class through
+    relationships. Loader criteria propagate to later lazy loads, so those
+    related classes still need theirs.
+    """
+    edges = {
+        m.local_table.fullname: {r.mapper.local_table.fullname for r in m.relationships}
+        for m in Base.registry.mappers
+    }
+    reach = {}
+    for start in edges:
+        seen, todo = {start}, [start]
+        while todo:
+            for nxt in edges.get(todo.pop(), ()):
+                if nxt not in seen:
+                    seen.add(nxt)
+                    todo.append(nxt)
+        reach[start] = frozenset(seen)
+    return reach
+
+def _stmt_tables(stmt, n_mappers):
+    """
+    Names of the tables a statement reads from (subqueries and related classes
+    included); None when that can't be told (loader options, lambda
+    statements), so the caller falls back to filtering every class.
+    """
+    if getattr(stmt, "_with_options", ()):
+        return None   # joinedload() etc. pull in entities the FROMs don't show
+    names = set()
+    for el in visitors.iterate(stmt):
+        t = el if isinstance(el, Table) else getattr(el, "table", None)
+        if isinstance(t, Table):
+            names.add(t.fullname)
+    if not names:
+        return None
+    reach = _reachable_tables(n_mappers)
+    return names.union(*(reach.get(n, ()) for n in names))
+
 @event.listens_for(model, "do_orm_execute")
 def _add_rbac_filters(execute_state):
     if not execute_state.is_select:
@@ -107,67 +311,63 @@ def _add_rbac_filters(execute_state):
     if role in {"developer", "admin", "finance_manager"}:
         return
 
-    brands   = set(session.get("user_brand_access") or [])
-    cats     = set(session.get("user_category_access_ids") or [])
-    cust_ids = set(session.get("user_customer_access_ids") or [])
+    scope = _rbac_scope()
+    brands, cats, cust_ids = scope["brands"], scope["cats"], scope["cust_ids"]
+    if not (brands or cats or cust_ids):
+        return
 
     opts = []
+    n_mappers = len(Base.registry.mappers)
+    brand_classes, cust_classes, cat_classes, sku_classes = _rbac_classes(n_mappers)
+
+    # only criteria for classes this statement actually touches
+    tables = _stmt_tables(execute_state.statement, n_mappers)
+    if tables is not None:
+        brand_classes, cust_classes, cat_classes, sku_classes = (
+            [cls for cls in group if cls.__table__.fullname in tables]
+            for group in (brand_classes, cust_classes, cat_classes, sku_classes)
+        )
 
     # BRAND: apply to any mapped class having a Brand column
     if brands:
-        for m in Base.registry.mappers:
-            cls = m.class_
-            if hasattr(cls, "Brand"):
-                opts.append(
-                    with_loader_criteria(
-                        cls, lambda c: c.Brand.in_(brands), include_aliases=True
-                    )
-                )
+        opts.extend(_scoped_crits(scope, _brand_crit, brand_classes, brands))
 
     # CUSTOMER: apply to any mapped class having a CustomerID column
     if cust_ids:
-        for m in Base.registry.mappers:
-            cls = m.class_
-            if hasattr(cls, "CustomerID"):
-                opts.append(
-                    with_loader_criteria(
-                        cls, lambda c: c.CustomerID.in_(cust_ids), include_aliases=True
-                    )
-                )
+        opts.extend(_scoped_crits(scope, _cust_crit, cust_classes, cust_ids))
 
     # CATEGORY: if a class has CategoryMappingID, filter directly; if it has SKU_ID,
-    # filter via EXISTS(select SP_SKU where SP_SKU.SKU_ID=cls.SKU_ID AND Category in allowed)
+    # filter via EXISTS on SP_SKU's category
     if cats:
         # 1) direct category-bearing tables
-        for m in Base.registry.mappers:
-            cls = m.class_
-            if hasattr(cls, "CategoryMappingID"):
-                opts.append(
-                    with_loader_criteria(
-                        cls, lambda c: c.CategoryMappingID.in_(cats), include_aliases=True
-                    )
-                )
-        # 2) SKU_ID-based tables (e.g., SP_MCSI_SellOut)
-        from sqlalchemy.sql import exists, select, and_
-        for m in Base.registry.mappers:
-            cls = m.class_
-            if hasattr(cls, "SKU_ID"):
-                opts.append(
-                    with_loader_criteria(
-                        cls,
-                        lambda c: exists(
-                            select(SP_SKU.SKU_ID).where(
-                                and_(SP_SKU.SKU_ID == c.SKU_ID,
-                                     SP_SKU.CategoryMappingID.in_(cats))
-                            )
-                        ),
-                        include_aliases=True
-                    )
-                )
+        opts.extend(_scoped_crits(scope, _cat_crit, cat_classes, cats))
+        # 2) SKU_ID-based tables (e.g., SP_MCSI_SellOut): an IN-list of the
+        #    request's allowed SKUs; correlated EXISTS when that list is too long
+        if sku_classes:
+            if "sku_ids" not in scope:
+                scope["sku_ids"] = _allowed_sku_ids(cats)
+            if scope["sku_ids"] is not None:
+                opts.extend(_scoped_crits(scope, _sku_crit, sku_classes, scope["sku_ids"]))
+            else:
+                opts.extend(_scoped_crits(scope, _sku_cat_crit, sku_classes, cats))
 
     if opts:
         execute_state.statement = execute_state.statement.options(*opts)
 
+def rbac_hides_rows(cls) -> bool:
+    """
+    True when the current user's RBAC criteria can filter rows of `cls`, i.e.
+    aggregates shared by every user (SP_SellOutUploadSummary) would count rows
+    this user can't open. Mirrors the checks in _add_rbac_filters.
+    """
+    if (session.get("role") or "") in {"developer", "admin", "finance_manager"}:
+        return False
+    scope = _rbac_scope()
+    brand_classes, cust_classes, cat_classes, sku_classes = _rbac_classes(len(Base.registry.mappers))
+    return ((bool(scope["brands"]) and cls in brand_classes)
+            or (bool(scope["cust_ids"]) and cls in cust_classes)
+            or (bool(scope["cats"]) and (cls in cat_classes or cls in sku_classes)))
+
 # --- NEW: Users & access maps (simplest shape) ------------------------------
 class SP_Users(Base):
     __tablename__ = "SP_Users"
@@ -323,6 +523,9 @@ class RTOS_MCSI(Base):
     # Define the composite primary key constraint
     __table_args__ = (
         PrimaryKeyConstraint('Article', 'BillingDocument', 'CreatedAt'),
+        # RBAC brand filter + date range: seek instead of scanning the PK
+        Index("IX_B2B_SO_Brand_Date", "Brand", "DocumentDate",
+              mssql_include=["Net", "GrInvSls", "GrossSale"]),
     )
 
 # ----SELL-Related----
@@ -330,6 +533,9 @@ class RTOS_MCSI(Base):
 class SP_MCSI_SellIn(Base):
     __tablename__ = 'SP_MCSI_SellIn'
 
+    # narrow clustered key: API loads append instead of splitting pages on
+    # Article order, and every NCI carries 8 bytes instead of the natural key
+    RowID = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
     ID = Column('Id', String(20), key='ID')
     SalesOffice = Column(String(100))
     SalesGroup = Column(String(100))
@@ -337,8 +543,8 @@ class SP_MCSI_SellIn(Base):
     Payer = Column('PayerName', String(100), key='Payer')
     ProductHierarchy1 = Column(String(100))
     ProductHierarchy2 = Column(String(100))
-    Article = Column(String(100))
-    BillingDocument = Column(String(100))
+    Article = Column(String(100), nullable=False)
+    BillingDocument = Column(String(100), nullable=False)
     Brand = Column('BrandName', String(100), key='Brand')
     DocumentDate = Column('Date', Date, key='DocumentDate')
     GrInvSls = Column('InvoicedGrossSales', Float, key='GrInvSls')
@@ -348,13 +554,34 @@ class SP_MCSI_SellIn(Base):
     CredMemos = Column('CreditMemos', Float, key='CredMemos')
     Net = Column('NetValue', Float, key='Net')
     GrossSale = Column('GrossSalesQty', Float, key='GrossSale')
-    CreatedAt = Column(Date)
+    CreatedAt = Column(Date, nullable=False)
     CapturedAt = Column(DateTime, default=func.now())  # Capture timestamp
 
     __table_args__ = (
-        PrimaryKeyConstraint('Article', 'BillingDocument', 'CreatedAt'),
+        # natural key, demoted to a nonclustered unique constraint
+        UniqueConstraint('Article', 'BillingDocument', 'CreatedAt', name='UQ_SellIn_NatKey'),
+        # RBAC brand filter + date range: seek instead of scanning the PK
+        Index("IX_SellIn_Brand_Date", "Brand", "DocumentDate",
+              mssql_include=["Net", "GrInvSls", "GrossSale"]),
     )   
 
+SELLIN_PAGE = 1000   # rows per executemany; fast_executemany ships each page as one parameter array
+
+def bulk_insert_sellin(session, rows, page=SELLIN_PAGE):
+    """
+    Load API sell-in rows (dicts keyed by SP_MCSI_SellIn attribute names) with
+    one ORM bulk INSERT per page, all in a single transaction. Returns the count.
+    Pass a BulkSession() so the load stays off the request pool.
+    """
+    stmt = insert(SP_MCSI_SellIn)
+    it = iter(rows)
+    n = 0
+    with (session.begin_nested() if session.in_transaction() else session.begin()):
+        while chunk := list(islice(it, page)):
+            session.execute(stmt, chunk)
+            n += len(chunk)
+    return n
+
 class SP_SellInFilters(Base):
     __tablename__ = 'SP_SellInFilters'
 
@@ -407,6 +634,9 @@ class SP_SKU(Base):
 
     __table_args__ = (
         Index("IX_SP_SKU_Brand_CategoryMappingID", "Brand", "CategoryMappingID"),
+        # category-led: the RBAC allowed-SKU lookup (_allowed_sku_ids) and the
+        # category EXISTS seek here; SKU_ID rides along as the clustered key
+        Index("IX_SP_SKU_CategoryMappingID", "CategoryMappingID"),
     )
 
 class SP_Customer_SKU_Map(Base):
@@ -450,7 +680,18 @@ class SP_MCSI_SellOut(Base):
     ReportedSOH = Column(Float)
     IsActive    = Column(Boolean, nullable=False, default=True)
     
-    SKU = relationship("SP_SKU", lazy="joined", primaryjoin="SP_MCSI_SellOut.SKU_ID==SP_SKU.SKU_ID")
+    # selectin: one IN query per batch instead of widening every SellOut SELECT
+    # with an OUTER JOIN; callers that want it inline pass joinedload()
+    SKU = relationship("SP_SKU", lazy="selectin", primaryjoin="SP_MCSI_SellOut.SKU_ID==SP_SKU.SKU_ID")
+
+    __table_args__ = (
+        # active lines of an upload in (SKU, date, row) order: the approval
+        # preview and the summary read only this; queries must say IsActive = 1
+        # literally (true()) for SQL Server to match the filter
+        Index("IX_SO_Upload_Active_SkuDate", "UploadID", "SKU_ID", "DocumentDate",
+              mssql_where=text("IsActive = 1"),
+              mssql_include=["SellOutQty", "ReportedSOH", "CustSKUCode"]),
+    )
 
 class SP_SellOutUploadAudit(Base):
     __tablename__ = "SP_SellOutUploadAudit"
@@ -493,11 +734,12 @@ class SP_SellOutUploads(Base):
     
     HasPotentialNegatives = Column(Boolean, nullable=False, server_default=text("0"))
     NegPreviewComputedAt  = Column(DateTime(timezone=False))
+    NegPreviewStatus      = Column(String(10))   # 'Pending'|'Ready'|'Failed' (background preview job)
     
     Approver = relationship(
         "SP_Users",
         primaryjoin="SP_SellOutUploads.ApprovedBy==SP_Users.UserID",
-        lazy="joined",
+        lazy="selectin",
         viewonly=True
     )
     
@@ -509,6 +751,9 @@ class SP_SellOutUploads(Base):
             unique=True,
             mssql_where=(SourceFileHash.isnot(None))
         ),
+        # RBAC customer/brand filter and the overlap lookup on re-upload
+        Index("IX_SO_Uploads_CustBrandPeriod", "CustomerID", "Brand", "PeriodStart",
+              mssql_include=["PeriodEnd", "LevelType", "UploadType", "Status"]),
     )
     
 # For any attachments 
@@ -520,9 +765,22 @@ class SP_SellOutUploadFile(Base):
     OriginalName = Column(String(255))
     MimeType     = Column(String(120))
     SizeBytes    = Column(Integer)
+    ContentHash  = Column(String(32), index=True)       # BLAKE2b-128 hex, for per-customer dedup
     UploadedBy   = Column(String(100))
     UploadedAt   = Column(DateTime, default=datetime.utcnow, nullable=False)
 
+# Per-upload aggregates for the approvals list (MSSQL has no materialized views,
+# so this is a plain summary table refreshed on write, see utils/sellout_summary.py)
+class SP_SellOutUploadSummary(Base):
+    __tablename__ = "SP_SellOutUploadSummary"
+    UploadID        = Column(Integer, ForeignKey("SP_SellOutUploads.UploadID", ondelete="CASCADE"), primary_key=True)
+    RowCount        = Column(Integer, nullable=False, default=0)   # active detail rows
+    DistinctSKU     = Column(Integer, nullable=False, default=0)
+    TotalSellOutQty = Column(Float,   nullable=False, default=0.0)
+    AttachmentCount = Column(Integer, nullable=False, default=0)
+    LastActedAt     = Column(DateTime)
+    RefreshedAt     = Column(DateTime, server_default=func.now(), nullable=False)
+
 # ------- END
 # Negative sellout to presist for audit
 class SP_SellOutNegPreview(Base):
@@ -718,6 +976,9 @@ class SP_SOH_Uploads(Base):
             unique=True,
             mssql_where=SourceFileHash.isnot(None)   # <-- important for SQL Server
         ),
+        # prior-header lookup of an upload: (customer, date) seek, brands from the key
+        Index("IX_SOH_Uploads_CustDateBrand", "CustomerID", "Date", "Brand",
+              mssql_include=["Status", "SnapshotType"]),
     )
 
 class SP_SOH_Detail(Base): #TODO PUSH TO PRD
@@ -738,6 +999,64 @@ class SP_SOH_Detail(Base): #TODO PUSH TO PRD
     )
 
 
+# --- Stale negative-preview guard (SQL Server triggers) ------------------------
+# Any ledger or SOH change for a (customer, SKU) that a Draft sell-out upload
+# touches clears that upload's NegPreviewComputedAt, so the persisted preview /
+# HasPotentialNegatives flag is treated as "recompute needed" instead of drifting.
+# CREATE OR ALTER (SQL Server 2016 SP1+) so install_stale_preview_triggers() can
+# be re-run against an existing database.
+_TR_LEDGER_STALE_PREVIEW = DDL("""
+CREATE OR ALTER TRIGGER TR_SP_InventoryLedger_StaleNegPreview ON SP_InventoryLedger
+AFTER INSERT, UPDATE, DELETE AS
+BEGIN
+    SET NOCOUNT ON;
+    UPDATE u SET NegPreviewComputedAt = NULL
+    FROM SP_SellOutUploads u
+    WHERE u.Status = 'Draft' AND u.NegPreviewComputedAt IS NOT NULL
+      AND EXISTS (
+          SELECT 1
+          FROM SP_MCSI_SellOut d
+          JOIN (SELECT CustomerID, SKU_ID FROM inserted
+                UNION SELECT CustomerID, SKU_ID FROM deleted) x ON x.SKU_ID = d.SKU_ID
+          WHERE d.UploadID = u.UploadID AND d.IsActive = 1 AND x.CustomerID = u.CustomerID);
+END
+""")
+
+_TR_SOH_STALE_PREVIEW = DDL("""
+CREATE OR ALTER TRIGGER TR_SP_SOH_Detail_StaleNegPreview ON SP_SOH_Detail
+AFTER INSERT, UPDATE, DELETE AS
+BEGIN
+    SET NOCOUNT ON;
+    UPDATE u SET NegPreviewComputedAt = NULL
+    FROM SP_SellOutUploads u
+    WHERE u.Status = 'Draft' AND u.NegPreviewComputedAt IS NOT NULL
+      AND EXISTS (
+          SELECT 1
+          FROM SP_MCSI_SellOut d
+          JOIN (SELECT SOHUploadID, SKU_ID FROM inserted
+                UNION SELECT SOHUploadID, SKU_ID FROM deleted) x ON x.SKU_ID = d.SKU_ID
+          JOIN SP_SOH_Uploads h ON h.SOHUploadID = x.SOHUploadID
+          WHERE d.UploadID = u.UploadID AND d.IsActive = 1 AND h.CustomerID = u.CustomerID);
+END
+""")
+
+event.listen(SP_InventoryLedger.__table__, "after_create", _TR_LEDGER_STALE_PREVIEW.execute_if(dialect="mssql"))
+event.listen(SP_SOH_Detail.__table__, "after_create", _TR_SOH_STALE_PREVIEW.execute_if(dialect="mssql"))
+
+
+def install_stale_preview_triggers(eng=engine):
+    """
+    Create/refresh the two triggers on an existing database. create_all only
+    fires after_create for new tables, so run this once per deployment:
+        python -c "import models; models.install_stale_preview_triggers()"
+    """
+    if eng.dialect.name != "mssql":
+        return
+    with eng.begin() as conn:
+        conn.execute(_TR_LEDGER_STALE_PREVIEW)
+        conn.execute(_TR_SOH_STALE_PREVIEW)
+
+
 
 # Base.metadata.create_all(engine)
 # 
\ No newline at end of file
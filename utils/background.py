@@ -0,0 +1,46 @@
+# utils/background.py
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# one small shared pool for work that shouldn't run on the request thread
+_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="sp-bg")
+
+_inflight = set()
+_inflight_lock = threading.Lock()
+
+
+def submit(fn, *args, key=None, **kwargs) -> bool:
+    """
+    Run fn(*args, **kwargs) on the shared background pool.
+    With a key, at most one task per key is queued/running at a time
+    (returns False if one already is). Exceptions are logged, not raised.
+
+    Background tasks have no Flask request/app context: open a fresh
+    models.Session() instead of using the per-request `model`.
+    """
+    if key is not None:
+        with _inflight_lock:
+            if key in _inflight:
+                return False
+            _inflight.add(key)
+
+    def _run():
+        try:
+            fn(*args, **kwargs)
+        except Exception:
+            log.exception("Background task %s failed", getattr(fn, "__name__", fn))
+        finally:
+            if key is not None:
+                with _inflight_lock:
+                    _inflight.discard(key)
+
+    _pool.submit(_run)
+    return True
+
+
+def is_inflight(key) -> bool:
+    with _inflight_lock:
+        return key in _inflight
@@ -0,0 +1,103 @@
+# utils/sellout_summary.py
+from datetime import datetime
+from sqlalchemy import select, insert, delete, distinct, func, true
+
+from models import (
+    SP_MCSI_SellOut, SP_SellOutUploadFile, SP_SellOutApproval, SP_SellOutUploadSummary
+)
+
+
+def compute_upload_summaries(session, upload_ids) -> dict:
+    """
+    Aggregate RowCount / DistinctSKU / TotalSellOutQty (active rows only),
+    AttachmentCount and LastActedAt for the given uploads.
+    Returns {UploadID: {...}} with an entry for every requested id.
+
+    Runs on the raw connection so the per-user RBAC criteria (do_orm_execute)
+    are not applied: the summary is shared by every user. The detail aggregates
+    are therefore only served as-is to users RBAC doesn't narrow; scoped users
+    get scoped_detail_aggregates() instead.
+    """
+    ids = sorted({int(x) for x in upload_ids or [] if x})
+    if not ids:
+        return {}
+
+    out = {uid: {"UploadID": uid, "RowCount": 0, "DistinctSKU": 0, "TotalSellOutQty": 0.0,
+                 "AttachmentCount": 0, "LastActedAt": None} for uid in ids}
+    conn = session.connection()
+
+    det = conn.execute(
+        select(SP_MCSI_SellOut.UploadID,
+               func.count(),
+               func.count(distinct(SP_MCSI_SellOut.SKU_ID)),
+               func.coalesce(func.sum(SP_MCSI_SellOut.SellOutQty), 0.0))
+        .where(SP_MCSI_SellOut.UploadID.in_(ids),
+               SP_MCSI_SellOut.IsActive == true())
+        .group_by(SP_MCSI_SellOut.UploadID)
+    ).all()
+    for uid, rowcount, distinct_sku, total_qty in det:
+        out[uid].update(RowCount=int(rowcount or 0), DistinctSKU=int(distinct_sku or 0),
+                        TotalSellOutQty=float(total_qty or 0.0))
+
+    att = conn.execute(
+        select(SP_SellOutUploadFile.UploadID, func.count())
+        .where(SP_SellOutUploadFile.UploadID.in_(ids))
+        .group_by(SP_SellOutUploadFile.UploadID)
+    ).all()
+    for uid, cnt in att:
+        out[uid]["AttachmentCount"] = int(cnt or 0)
+
+    appr = conn.execute(
+        select(SP_SellOutApproval.UploadID, func.max(SP_SellOutApproval.ActedAt))
+        .where(SP_SellOutApproval.UploadID.in_(ids))
+        .group_by(SP_SellOutApproval.UploadID)
+    ).all()
+    for uid, last_acted in appr:
+        out[uid]["LastActedAt"] = last_acted
+
+    return out
+
+
+def scoped_detail_aggregates(session, upload_ids) -> dict:
+    """
+    RowCount / DistinctSKU / TotalSellOutQty for the given uploads through the
+    ORM, so the caller's RBAC criteria apply. For users whose access is narrower
+    than the shared summary (see models.rbac_hides_rows).
+    """
+    ids = sorted({int(x) for x in upload_ids or [] if x})
+    out = {uid: {"RowCount": 0, "DistinctSKU": 0, "TotalSellOutQty": 0.0} for uid in ids}
+    if not ids:
+        return out
+    det = session.execute(
+        select(SP_MCSI_SellOut.UploadID,
+               func.count(),
+               func.count(distinct(SP_MCSI_SellOut.SKU_ID)),
+               func.coalesce(func.sum(SP_MCSI_SellOut.SellOutQty), 0.0))
+        .where(SP_MCSI_SellOut.UploadID.in_(ids),
+               SP_MCSI_SellOut.IsActive == true())
+        .group_by(SP_MCSI_SellOut.UploadID)
+    ).all()
+    for uid, rowcount, distinct_sku, total_qty in det:
+        out[uid].update(RowCount=int(rowcount or 0), DistinctSKU=int(distinct_sku or 0),
+                        TotalSellOutQty=float(total_qty or 0.0))
+    return out
+
+
+def refresh_upload_summary(session, upload_ids) -> dict:
+    """
+    Recompute and upsert SP_SellOutUploadSummary rows for the given uploads.
+    Flushes pending ORM changes first (sessions here run with autoflush=False).
+    Caller owns the commit.
+    """
+    session.flush()
+    summaries = compute_upload_summaries(session, upload_ids)
+    if not summaries:
+        return summaries
+
+    now = datetime.utcnow()
+    conn = session.connection()
+    conn.execute(delete(SP_SellOutUploadSummary)
+                 .where(SP_SellOutUploadSummary.UploadID.in_(list(summaries))))
+    conn.execute(insert(SP_SellOutUploadSummary),
+                 [dict(s, RefreshedAt=now) for s in summaries.values()])
+    return summaries